@@ -57,6 +57,10 @@ class ReverseSuite(flimsy.TestSuite):
         return reversed(self.tests)
 ReverseSuite(tests=tests, name='Reversed Truth Tests')
 
+# When running with multiple jobs (`flimsy run -j N`) suites run in parallel, but the tests within a suite still run in order.
+# If the tests of a suite do not depend on each other, mark the suite parallel so idle workers may steal its tests.
+flimsy.TestSuite(tests=[Test(True, name='Parallel %d' % idx) for idx in range(4)], name='Parallel Tests', parallel=True)
+
 ############
 # Fixtures
 ############
@@ -112,6 +116,30 @@ class BuildTargetFixture(flimsy.Fixture):
 # When each BuildTargetFixture is initialized before tests begin, they add themselves to this list.
 # Then, just before the first test suite begins running, the setup method of the BuildSystemFixture is executed, and all the targets are supplied to make.
 
+# By default a fixture is set up and torn down around every test or suite which lists it.
+# A fixture shared by many tests, like a built binary, may instead declare a scope of 'suite' or 'session'.
+# It is then set up once for each suite (or once for the whole run) by its first user, and torn down after its last user in the schedule finishes.
+# Subclasses which override `schedule_finalized` must call the base class method, which counts those users.
+#simulator_fixture = BuildTargetFixture('simulator', scope='session')
+
+# Fixtures may also depend on other fixtures, which are then always set up before them.
+# Fixtures which don't depend on each other are set up in parallel when running with multiple jobs.
+#BuildTargetFixture('tests', depends=[simulator_fixture])
+
+# A fixture which returns a key from `cache_key` (e.g. a hash of its sources or a revision) has the `outputs` it creates saved in a cache shared between runs.
+# While the key is unchanged, later runs restore the outputs rather than calling setup, and concurrent runs wait for one build rather than each building.
+class CachedBuildFixture(flimsy.Fixture):
+    def cache_key(self, testitem):
+        return 'v1'
+    def setup(self, testitem):
+        import os, subprocess
+        subprocess.check_call(['make', '-C', os.path.dirname(self.outputs[0])])
+#CachedBuildFixture(outputs=['build/simulator'], scope='session')
+
+# A global fixture may declare the tags (or tests) it serves.
+# If none of the tests left after filtering with --include-tags/--exclude-tags are served by it, it is pruned and never set up.
+#flimsy.globalfixture(BuildTargetFixture('arm-simulator', tags=['ARM']))
+
 
 # Fixtures can also skip tests if they are unable to perform the necessary initialization.
 class SkipFixture(flimsy.Fixture):
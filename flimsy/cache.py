@@ -0,0 +1,318 @@
+'''
+A size bounded, content-addressed store of files shared between runs, and
+the result cache built on it.
+
+Each entry of a :class:`CacheStore` is a directory named by its key holding
+the files stored under that key. Entries are written to a temporary
+directory and renamed into place so readers never see a partial entry, and
+a lock file serializes writers and eviction across concurrent ``flimsy``
+processes. Reading an entry updates its modification time, and once the
+store grows past its size limit the least recently used entries are
+removed.
+
+Tests which set ``cache`` are skipped when a previous run passed with the
+same inputs: the test's uid, its source file and the files it imports, the
+files declared as ``inputs`` by its fixtures and the values of configured
+environment variables. Their stored output is replayed instead.
+
+Fixtures which return a key from ``cache_key`` have the ``outputs`` they
+produced stored under it, and restored rather than calling ``setup`` while
+the key is unchanged. A lock on the key lets concurrent runs wait for each
+other's build rather than repeating it.
+'''
+import contextlib
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import compression
+import helper
+import log
+from state import Status, Result
+
+# The ResultCache used by the runners, or None if caching is disabled.
+results = None
+# The ArtifactCache used by fixtures, or None if caching is disabled.
+artifacts = None
+
+def hash_files(sha, paths):
+    '''Update the hash object with the names and contents of the files.'''
+    for path in sorted(paths):
+        sha.update('%d:%s' % (len(path), path))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), ''):
+                    sha.update(chunk)
+
+def _copy(source, destination):
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, symlinks=True)
+    else:
+        shutil.copy2(source, destination)
+
+def _tree_size(path):
+    size = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return size
+
+
+class CacheStore(object):
+    '''
+    :param directory: Directory holding the store, created when it is first
+        used.
+    :param max_size: Size in bytes the store is evicted down to after
+        entries are added, or ``None`` for no limit.
+    '''
+    lockname = 'lock'
+    tmpdir = 'tmp'
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _tmpdir(self):
+        # Created on first use, so runs caching nothing leave no store.
+        path = os.path.join(self.directory, self.tmpdir)
+        helper.mkdir_p(path)
+        return path
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @contextlib.contextmanager
+    def lock(self, name=None, shared=False):
+        '''
+        Hold an flock on the lock file of the store, or on the lock named
+        name for locks which don't need to exclude the whole store.
+        '''
+        if name is None:
+            name = self.lockname
+        path = os.path.join(self._tmpdir(), name + '.lock')
+        with open(path, 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def get(self, key):
+        '''
+        Return the directory of the entry for key, marking it as recently
+        used, or ``None`` if there is no such entry.
+        '''
+        path = self.path(key)
+        with self.lock(shared=True):
+            try:
+                os.utime(path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None
+        return path
+
+    def put(self, key, files):
+        '''
+        Store copies of files under key, replacing any existing entry.
+
+        :param files: Dict mapping names within the entry to the paths of the
+            files or directories to copy. Missing paths are stored as empty
+            files.
+        '''
+        tmp = tempfile.mkdtemp(dir=self._tmpdir())
+        try:
+            for name, source in files.items():
+                destination = os.path.join(tmp, name)
+                helper.mkdir_p(os.path.dirname(destination))
+                if os.path.exists(source):
+                    _copy(source, destination)
+                else:
+                    open(destination, 'w').close()
+            os.utime(tmp, None)
+
+            path = self.path(key)
+            with self.lock():
+                helper.mkdir_p(os.path.dirname(path))
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.rename(tmp, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        '''Return the paths of all entries, least recently used first.'''
+        entries = []
+        for prefix in os.listdir(self.directory):
+            if prefix == self.tmpdir:
+                continue
+            prefix = os.path.join(self.directory, prefix)
+            for key in os.listdir(prefix):
+                entries.append(os.path.join(prefix, key))
+        return sorted(entries, key=os.path.getmtime)
+
+    def evict(self):
+        '''Remove least recently used entries until under max_size.'''
+        if self.max_size is None or not os.path.isdir(self.directory):
+            return
+        with self.lock():
+            entries = [(path, _tree_size(path)) for path in self.entries()]
+            size = sum(entry_size for path, entry_size in entries)
+            for path, entry_size in entries:
+                if size <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                size -= entry_size
+
+
+class ResultCache(object):
+    '''
+    Replays the output of tests which passed with the same inputs.
+
+    :param store: The :class:`CacheStore` results are kept in.
+    :param environment: Names of environment variables whose values are
+        part of every key.
+    :param dependencies: Optional :class:`dependency.DependencyGraph` of the
+        files imported by test files, which are hashed along with them.
+
+    :attr global_fixtures: The global fixtures set up for the run, which
+        are part of every key. Set once those serving no test are pruned.
+    '''
+    global_fixtures = ()
+
+    def __init__(self, store, environment=(), dependencies=None):
+        self.store = store
+        self.environment = sorted(environment)
+        self.dependencies = dependencies
+
+    def key(self, test, fixtures):
+        '''
+        Return the key for the test when run with the given fixtures and the
+        global fixtures.
+        '''
+        sha = hashlib.sha1()
+        def update(*strings):
+            for string in strings:
+                sha.update('%d:%s' % (len(string), string))
+
+        update(test.parent_suite.uid, test.uid)
+        sources = set([test.path])
+        if self.dependencies is not None:
+            sources = self.dependencies.dependencies(test.path)
+        for fixture in list(self.global_fixtures) + list(fixtures):
+            update(fixture.name)
+            sources.update(fixture.inputs)
+        hash_files(sha, sources)
+        for name in self.environment:
+            update(name, repr(os.environ.get(name)))
+        return sha.hexdigest()
+
+    def replay(self, test, key):
+        '''
+        Log the stored output and a passing result for the test if there is
+        an entry for key.
+
+        :returns: True if the test was replayed.
+        '''
+        # Keep the entry from being evicted while it is read.
+        with self.store.lock(shared=True):
+            path = self.store.get(key)
+            if path is None:
+                return False
+            log.test_log.debug('Replaying the cached result of %s' % test.uid)
+            start = time.time()
+            test.status = Status.Running
+            suite = test.parent_suite
+            for name, callback in (('stdout', log.test_log.test_stdout),
+                                   ('stderr', log.test_log.test_stderr)):
+                f = compression.open_output(
+                        compression.find_output(os.path.join(path, name)))
+                try:
+                    for chunk in iter(lambda: f.read(1 << 16), ''):
+                        callback(test, suite, chunk)
+                finally:
+                    f.close()
+        test.result = Result(Result.Passed)
+        test.runtime = time.time() - start
+        test.status = Status.Complete
+        return True
+
+    def save(self, key, stdout, stderr):
+        '''
+        Store the output files of a passing test, which are kept compressed
+        if they were.
+        '''
+        files = {}
+        for name, path in (('stdout', stdout), ('stderr', stderr)):
+            codec = compression.codec_of(path)
+            files[name + (codec.suffix if codec else '')] = path
+        self.store.put(key, files)
+
+
+class ArtifactCache(object):
+    '''
+    Restores the outputs of fixtures set up with the same key by this or an
+    earlier run.
+
+    :param store: The :class:`CacheStore` outputs are kept in.
+    '''
+    def __init__(self, store):
+        self.store = store
+
+    def key(self, fixture, key):
+        sha = hashlib.sha1()
+        for string in [fixture.__class__.__name__, fixture.name, key]:
+            sha.update('%d:%s' % (len(string), string))
+        for path in fixture.outputs:
+            sha.update('%d:%s' % (len(path), path))
+        return sha.hexdigest()
+
+    def setup(self, fixture, testitem):
+        '''
+        Restore the outputs of the fixture if they are stored under its
+        key, otherwise set it up and store them.
+        '''
+        key = fixture.cache_key(testitem)
+        if key is None:
+            fixture.setup(testitem)
+            return
+        key = self.key(fixture, key)
+
+        # Hold the key while building so other runs wait for this build.
+        with self.store.lock(key):
+            if self.restore(fixture, key):
+                return
+            fixture.setup(testitem)
+            missing = [path for path in fixture.outputs
+                       if not os.path.exists(path)]
+            if missing:
+                log.test_log.warn('Not caching fixture %s, it did not create'
+                                  ' %s' % (fixture.name, ', '.join(missing)))
+                return
+            self.store.put(key, dict((str(idx), path) for idx, path
+                                     in enumerate(fixture.outputs)))
+        self.store.evict()
+
+    def restore(self, fixture, key):
+        # Keep the entry from being evicted while it is copied.
+        with self.store.lock(shared=True):
+            entry = self.store.get(key)
+            if entry is None:
+                return False
+            log.test_log.info('Restoring the cached outputs of fixture %s'
+                              % fixture.name)
+            for idx, path in enumerate(fixture.outputs):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                elif os.path.lexists(path):
+                    os.remove(path)
+                helper.mkdir_p(os.path.dirname(path))
+                _copy(os.path.join(entry, str(idx)), path)
+        return True
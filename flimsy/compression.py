@@ -0,0 +1,112 @@
+'''
+Compression of the test output saved in the results directory.
+
+Output is compressed as it is written by the codec chosen with
+``--compress``, which adds its suffix to the name of the file. Readers pick
+the codec from the suffix, so output written with different codecs, or with
+none, can sit in the same results directory.
+
+gzip is always available, lz4 only if the ``lz4`` package is installed.
+'''
+import functools
+import gzip
+import os
+import shutil
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Codec(object):
+    '''
+    :param suffix: Suffix of the names of files written with the codec.
+    :param opener: Function taking a path and mode and returning a file
+        object which compresses what is written to it and decompresses what
+        is read from it. Files opened in append mode add to a file earlier
+        written with the codec.
+    :param wrapper: Function like opener taking an open file object rather
+        than a path, which it leaves open when closed.
+    '''
+    def __init__(self, name, suffix, opener, wrapper):
+        self.name = name
+        self.suffix = suffix
+        self.opener = opener
+        self.wrapper = wrapper
+
+    def open(self, path, mode='r'):
+        return self.opener(path, mode)
+
+    def wrap(self, fileobj, mode='r'):
+        return self.wrapper(fileobj, mode)
+
+# Codecs available to compress output with, by name.
+codecs = {
+    # The default level 9 costs far more time than it saves space on text.
+    'gzip': Codec('gzip', '.gz',
+                  functools.partial(gzip.open, compresslevel=6),
+                  lambda fileobj, mode: gzip.GzipFile(
+                      fileobj=fileobj, mode=mode + 'b', compresslevel=6)),
+}
+if lz4 is not None:
+    # lz4 opens either paths or file objects.
+    codecs['lz4'] = Codec('lz4', '.lz4', lz4.frame.open, lz4.frame.open)
+
+def codec_of(path):
+    '''Return the codec the file at path was written with, or None.'''
+    for codec in codecs.values():
+        if path.endswith(codec.suffix):
+            return codec
+    return None
+
+def open_output(path, mode='r'):
+    '''
+    Open the output file at path, compressing or decompressing it with the
+    codec of its suffix if it has one.
+    '''
+    codec = codec_of(path)
+    if codec is None:
+        return open(path, mode)
+    return codec.open(path, mode)
+
+def variants(path):
+    '''
+    Return the paths the output which would be at path if uncompressed may
+    be stored at.
+    '''
+    return [path] + [path + codec.suffix for codec in codecs.values()]
+
+def find_output(path):
+    '''
+    Return the path of the stored variant of the output at path, or path
+    itself if there is none.
+    '''
+    for variant in variants(path):
+        if os.path.exists(variant):
+            return variant
+    return path
+
+def remove_output(path):
+    '''Remove every stored variant of the output at path.'''
+    for variant in variants(path):
+        if os.path.exists(variant):
+            os.remove(variant)
+
+def compress_file(path, codec):
+    '''
+    Replace the uncompressed file at path, and any variants of it compressed
+    with other codecs, with one compressed with codec. Returns its path.
+    '''
+    compressed = path + codec.suffix
+    for variant in variants(path)[1:]:
+        if os.path.exists(variant):
+            os.remove(variant)
+    with open(path, 'rb') as source:
+        destination = codec.open(compressed, 'w')
+        try:
+            shutil.copyfileobj(source, destination, 1 << 16)
+        finally:
+            destination.close()
+    os.remove(path)
+    return compressed
@@ -45,6 +45,8 @@ import re
 from pickle import HIGHEST_PROTOCOL as highest_pickle_protocol
 
 from helper import absdirpath, AttrDict, FrozenAttrDict
+import compression
+import shard
 
 
 # TODO/FIXME Reconcile module/test collection config items with the global config.
@@ -193,6 +195,13 @@ def define_constants(constants):
     '''
     constants.pickle_protocol = highest_pickle_protocol
 
+    # File names of the saved results within the results directory.
+    constants.pickle_filename = 'results.pickle'
+    constants.xml_filename = 'results.xml'
+    constants.phases_filename = 'phases.json'
+    constants.pack_filename = 'output.pack'
+    constants.pack_index_filename = 'output.index'
+
     # The root directory which all test names will be based off of.
     constants.testing_base = absdirpath(os.path.join(absdirpath(__file__),
                                                      os.pardir))
@@ -235,6 +244,24 @@ def define_post_processors(config):
     config._add_post_processor(StorePositionalTagsAction.position_kword, 
                                compile_tag_regex)
 
+def resource_budget(string):
+    '''
+    Argparse type converting ``name=amount[,name=amount...]`` into a dict of
+    resource amounts.
+    '''
+    budget = {}
+    for item in string.split(','):
+        name, sep, amount = item.partition('=')
+        try:
+            budget[name.strip()] = float(amount) if '.' in amount else int(amount)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                    'Invalid resource "%s", expected name=amount.' % item)
+        if not sep or not name.strip():
+            raise argparse.ArgumentTypeError(
+                    'Invalid resource "%s", expected name=amount.' % item)
+    return budget
+
 class StorePositionAction(argparse.Action):
     '''Base class for classes wishing to create namespaces where 
     arguments are stored in the order provided via the command line.
@@ -333,12 +360,189 @@ def define_common_args(config):
             '--include-tags',
             action=StorePositionalTagsAction,
             help='A tag comparison used to select tests.'),
+        Argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=1,
+            help='Number of sandboxed tests to run in parallel.'),
+        Argument(
+            '--isolation',
+            choices=('process', 'worker', 'batch', 'none'),
+            default=None,
+            help='How tests are isolated from the runner, overriding what'
+                 ' they declare. "process" (the default for tests which'
+                 ' declare nothing) forks a new process for each test,'
+                 ' "worker" reuses persistent worker processes for tests'
+                 ' without their own fixtures, "batch" forks one process'
+                 ' for each batch of consecutive tests of a suite without'
+                 ' their own fixtures and "none" runs tests in the'
+                 ' runner\'s own process.'),
+        Argument(
+            '--worker-max-tests',
+            type=int,
+            default=100,
+            help='Number of tests a worker process runs before it is'
+                 ' replaced.'),
+        Argument(
+            '--batch-size',
+            type=int,
+            default=16,
+            help='Number of tests run by each process with "batch"'
+                 ' isolation.'),
+        Argument(
+            '--order',
+            choices=('scheduled', 'longest-first'),
+            default='scheduled',
+            help='Order in which to run suites. "longest-first" uses the'
+                 ' durations recorded by previous runs to start the longest'
+                 ' suites (and tests of parallel suites) first.'),
+        Argument(
+            '--default-duration',
+            type=float,
+            default=1.0,
+            help='Expected duration in seconds of tests without a recorded'
+                 ' duration when using --order longest-first.'),
+        Argument(
+            '--timeout',
+            type=float,
+            default=None,
+            help='Seconds after which a test which does not set its own'
+                 ' timeout is killed and marked as errored.'),
+        Argument(
+            '--resources',
+            type=resource_budget,
+            default=None,
+            help='Resources available to parallel tests as'
+                 ' name=amount[,name=amount...], e.g. cpus=64,memory_mb=128000,gpus=2.'
+                 ' cpus and memory_mb default to those of this machine.'),
+        Argument(
+            '--shard',
+            type=shard.shard_argument,
+            default=None,
+            help='Only select suites in shard K of N (K/N, counting from 1).'
+                 ' Suites sharing suite fixtures stay in the same shard.'),
+        Argument(
+            '--shard-balance',
+            action='store_true',
+            default=False,
+            help='Balance shards on the durations recorded by previous runs'
+                 ' rather than hashing suite uids. Every shard must use the'
+                 ' same durations file.'),
+        Argument(
+            '--changed-since',
+            default=None,
+            metavar='REV|FILE',
+            help='Only select suites whose test file, or a file it'
+                 ' (transitively) imports, changed since the given git'
+                 ' revision, or was modified after the given file.'),
+        Argument(
+            '--background-teardown',
+            action='store_true',
+            default=False,
+            help='Tear fixtures down on background threads so the next test'
+                 ' or suite can start without waiting for them.'),
+        Argument(
+            '--teardown-queue-size',
+            type=int,
+            default=8,
+            help='Number of background teardowns which may be pending'
+                 ' before a test waits to queue another.'),
+        Argument(
+            '--no-cache',
+            action='store_true',
+            default=False,
+            help='Run tests which set cache rather than replaying their'
+                 ' cached results, and set up fixtures rather than restoring'
+                 ' their cached outputs.'),
+        Argument(
+            '--cache-dir',
+            default=os.path.join(os.path.expanduser('~'), '.cache', 'flimsy'),
+            help='Directory of the cache shared between runs.'),
+        Argument(
+            '--cache-size',
+            type=int,
+            default=1024,
+            help='Size in MB the result cache is evicted down to, least'
+                 ' recently used first.'),
+        Argument(
+            '--fixture-cache-size',
+            type=int,
+            default=10240,
+            help='Size in MB the cache of fixture outputs is evicted down'
+                 ' to, least recently used first.'),
+        Argument(
+            '--cache-env',
+            action='append',
+            default=[],
+            metavar='NAME',
+            help='Environment variable whose value is part of the key of'
+                 ' cached results. May be given more than once.'),
+        Argument(
+            '--durations',
+            default=None,
+            help='File of recorded test durations to read and update.'
+                 ' Defaults to durations.pickle in the results directory.'),
         Argument(
             '-s',
             '--stream',
             action='store_true',
             default=False,
             help='Stream the output from stdout and stderr as tests run.'),
+        Argument(
+            '--capture',
+            choices=('pipe', 'file'),
+            default='pipe',
+            help='How the output of tests run in their own process is'
+                 ' captured. "pipe" logs it as it is read, "file" has the'
+                 ' test write it straight to its files in the results'
+                 ' directory, which is faster for tests with a lot of'
+                 ' output.'),
+        Argument(
+            '--output-limit',
+            type=int,
+            default=None,
+            metavar='BYTES',
+            help='Bytes of each output stream saved for tests which, along'
+                 ' with their suite, do not set an output_limit. Beyond it'
+                 ' only the first and last half of the limit are kept.'),
+        Argument(
+            '--compress',
+            choices=sorted(compression.codecs),
+            default=None,
+            help='Compress the output of tests as it is saved. Output'
+                 ' saved by earlier runs with other codecs, or'
+                 ' uncompressed, is still read.'),
+        Argument(
+            '--output-format',
+            choices=('files', 'packed'),
+            default='files',
+            help='How the output of tests is saved. "files" saves the'
+                 ' stdout and stderr of each test in files of their own,'
+                 ' "packed" appends all of it to a single file indexed by'
+                 ' test, which the export command unpacks.'),
+        Argument(
+            '--slowest',
+            type=int,
+            default=0,
+            metavar='N',
+            help='List the N slowest tests and the resources they used'
+                 ' after the results.'),
+        Argument(
+            '--phase-summary',
+            type=int,
+            default=0,
+            metavar='N',
+            help='List the N costliest steps of each phase of the run, e.g.'
+                 ' loading files or setting up fixtures, after the'
+                 ' results. The time of every step is saved to'
+                 ' phases.json in the results directory regardless.'),
+        Argument(
+            '--trace',
+            default=None,
+            metavar='FILE',
+            help='Write a timeline of the run to FILE in the Chrome trace'
+                 ' event format, for chrome://tracing or Perfetto.'),
         Argument(
             '-v',
             action='count',
@@ -397,8 +601,34 @@ class RunParser(ArgParser):
 
         common_args.directory.add_to(parser)
         common_args.stream.add_to(parser)
+        common_args.capture.add_to(parser)
+        common_args.output_limit.add_to(parser)
+        common_args.compress.add_to(parser)
+        common_args.output_format.add_to(parser)
+        common_args.slowest.add_to(parser)
+        common_args.phase_summary.add_to(parser)
+        common_args.trace.add_to(parser)
+        common_args.jobs.add_to(parser)
+        common_args.isolation.add_to(parser)
+        common_args.worker_max_tests.add_to(parser)
+        common_args.batch_size.add_to(parser)
+        common_args.order.add_to(parser)
+        common_args.default_duration.add_to(parser)
+        common_args.timeout.add_to(parser)
+        common_args.resources.add_to(parser)
+        common_args.background_teardown.add_to(parser)
+        common_args.teardown_queue_size.add_to(parser)
         common_args.include_tags.add_to(parser)
         common_args.exclude_tags.add_to(parser)
+        common_args.changed_since.add_to(parser)
+        common_args.shard.add_to(parser)
+        common_args.shard_balance.add_to(parser)
+        common_args.durations.add_to(parser)
+        common_args.no_cache.add_to(parser)
+        common_args.cache_dir.add_to(parser)
+        common_args.cache_size.add_to(parser)
+        common_args.fixture_cache_size.add_to(parser)
+        common_args.cache_env.add_to(parser)
 
 class ListParser(ArgParser):
     '''
@@ -433,6 +663,69 @@ class ListParser(ArgParser):
         common_args.directory.add_to(parser)
         common_args.include_tags.add_to(parser)
         common_args.exclude_tags.add_to(parser)
+        common_args.changed_since.add_to(parser)
+        common_args.shard.add_to(parser)
+        common_args.shard_balance.add_to(parser)
+        common_args.durations.add_to(parser)
+        common_args.default_duration.add_to(parser)
+
+class RerunParser(ArgParser):
+    '''
+    Parser for the "rerun" command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'rerun',
+            help='''Rerun the tests which failed or errored in a previous
+            run, merging their new results into it.'''
+        )
+        super(RerunParser, self).__init__(parser)
+
+        Argument(
+            'result_path',
+            nargs='?',
+            default=argparse.SUPPRESS,
+            help='Results directory of the run to rerun failures from.'
+        ).add_to(parser)
+
+        common_args.stream.add_to(parser)
+        common_args.capture.add_to(parser)
+        common_args.output_limit.add_to(parser)
+        common_args.compress.add_to(parser)
+        common_args.output_format.add_to(parser)
+        common_args.slowest.add_to(parser)
+        common_args.phase_summary.add_to(parser)
+        common_args.trace.add_to(parser)
+        common_args.jobs.add_to(parser)
+        common_args.isolation.add_to(parser)
+        common_args.worker_max_tests.add_to(parser)
+        common_args.batch_size.add_to(parser)
+        common_args.order.add_to(parser)
+        common_args.default_duration.add_to(parser)
+        common_args.timeout.add_to(parser)
+        common_args.resources.add_to(parser)
+        common_args.background_teardown.add_to(parser)
+        common_args.teardown_queue_size.add_to(parser)
+        common_args.durations.add_to(parser)
+
+class ExportParser(ArgParser):
+    '''
+    Parser for the "export" command.
+    '''
+    def __init__(self, subparser):
+        parser = subparser.add_parser(
+            'export',
+            help='''Unpack the packed output of a previous run into files of
+            their own for each test.'''
+        )
+        super(ExportParser, self).__init__(parser)
+
+        Argument(
+            'result_path',
+            nargs='?',
+            default=argparse.SUPPRESS,
+            help='Results directory of the run to unpack the output of.'
+        ).add_to(parser)
 
 config = _Config()
 define_constants(config.constants)
@@ -461,7 +754,8 @@ def initialize_config():
     baseparser = CommandParser()
     runparser = RunParser(baseparser.subparser)
     listparser = ListParser(baseparser.subparser)
-    #rerunparser = RerunParser(baseparser.subparser)
+    rerunparser = RerunParser(baseparser.subparser)
+    exportparser = ExportParser(baseparser.subparser)
     #clientparser = ClientParser(baseparser.subparser)
 
     # Initialize the config by parsing args and running callbacks.
@@ -0,0 +1,170 @@
+'''
+Tracking of the python source files each test file depends on, used to only
+select suites affected by a change.
+
+While a test file is loaded, every import is recorded as an edge from the
+file doing the import to the source file of the imported module. Modules are
+only executed the first time they are imported, so the graph is shared by
+all files loaded by a :class:`loader.Loader` and the dependencies of a test
+file are found by walking it transitively.
+
+Changed files are found with ``git diff --name-only`` against a revision, or
+by comparing the modification times of the files in the graph against a
+reference file, so neither requires network access.
+'''
+import __builtin__
+import contextlib
+import os
+import subprocess
+import types
+
+
+def source_path(module):
+    '''
+    Return the absolute path of the source file of the module, or ``None``
+    for builtin modules.
+    '''
+    return _source_file(getattr(module, '__file__', None))
+
+def _source_file(path):
+    if path is None:
+        return None
+    base, ext = os.path.splitext(path)
+    if ext in ('.pyc', '.pyo'):
+        path = base + '.py'
+    return os.path.abspath(path)
+
+
+class DependencyGraph(object):
+    '''
+    Edges from source files to the source files of the modules they import.
+    '''
+    def __init__(self):
+        self.imports = {}
+
+    def add(self, importer, imported):
+        if importer != imported:
+            self.imports.setdefault(importer, set()).add(imported)
+
+    def dependencies(self, path):
+        '''
+        Return the set of files the file at path transitively imports,
+        including path itself.
+        '''
+        seen = set()
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            if path not in seen:
+                seen.add(path)
+                stack.extend(self.imports.get(path, ()))
+        return seen
+
+    def files(self):
+        '''Return the set of all files in the graph.'''
+        files = set(self.imports)
+        for imported in self.imports.values():
+            files.update(imported)
+        return files
+
+    @contextlib.contextmanager
+    def record(self):
+        '''
+        Record the imports made while the context is active by wrapping the
+        builtin ``__import__``.
+        '''
+        real_import = __builtin__.__import__
+        def recording_import(name, globals=None, locals=None, fromlist=None,
+                             level=-1):
+            module = real_import(name, globals, locals, fromlist, level)
+            importer = _source_file((globals or {}).get('__file__'))
+            if importer is not None:
+                for imported in _imported_modules(module, name, fromlist):
+                    path = source_path(imported)
+                    if path is not None:
+                        self.add(importer, path)
+            return module
+
+        __builtin__.__import__ = recording_import
+        try:
+            yield
+        finally:
+            __builtin__.__import__ = real_import
+
+
+def _imported_modules(module, name, fromlist):
+    '''
+    Return the modules named by an import statement given the module
+    ``__import__`` returned for it.
+    '''
+    if fromlist:
+        # from package import name: names may be submodules.
+        modules = [module]
+        for attr in fromlist:
+            value = getattr(module, attr, None)
+            if isinstance(value, types.ModuleType):
+                modules.append(value)
+        return modules
+
+    # import a.b.c returns the top level package, record each level.
+    modules = [module]
+    for attr in name.split('.')[1:]:
+        module = getattr(module, attr, None)
+        if not isinstance(module, types.ModuleType):
+            break
+        modules.append(module)
+    return modules
+
+
+def changed_files(since, directory, paths):
+    '''
+    Return the set of absolute paths of files changed since ``since``.
+
+    :param since: Either the path of a file, in which case those of the given
+        paths modified after it are returned, or a git revision, in which
+        case the files git reports as changed in the working tree of
+        directory since that revision are returned along with untracked
+        files.
+    '''
+    if os.path.isfile(since):
+        return modified_since(os.path.getmtime(since), paths)
+    return git_changed_since(since, directory)
+
+def modified_since(mtime, paths):
+    changed = set()
+    for path in paths:
+        try:
+            if os.path.getmtime(path) > mtime:
+                changed.add(path)
+        except OSError:
+            # Removed files have changed.
+            changed.add(path)
+    return changed
+
+class ChangedFilesError(Exception):
+    '''Raised when the files changed since a git revision can't be found.'''
+
+def git_changed_since(revision, directory):
+    def git(cwd, *args):
+        try:
+            process = subprocess.Popen(('git',) + args, cwd=cwd,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError as e:
+            raise ChangedFilesError('Could not run git to find the files'
+                                    ' changed since %s in %s: %s'
+                                    % (revision, directory, e.strerror))
+        out, err = process.communicate()
+        if process.returncode:
+            raise ChangedFilesError('Could not find the files changed since'
+                                    ' %s in %s, git %s failed: %s'
+                                    % (revision, directory, args[0],
+                                       err.strip()))
+        return out
+    toplevel = git(directory, 'rev-parse', '--show-toplevel').strip()
+    # Both list paths relative to the top of the work tree.
+    names = git(toplevel, 'diff', '--name-only', revision, '--').splitlines()
+    names += git(toplevel, 'ls-files', '--others',
+                 '--exclude-standard').splitlines()
+    return set(os.path.abspath(os.path.join(toplevel, name))
+               for name in names if name)
@@ -1,15 +1,84 @@
+import os
+import Queue
+import sys
+import threading
 import traceback
 
+import six
+
+import cache
 import log
 import helper
 
 global_fixtures = []
 
+# The TeardownExecutor fixtures are torn down on, or None to tear them down
+# in the thread which releases them.
+teardown_executor = None
+
 class TestScheduleUnknown(Exception):
     pass
 
+class _ScopeInstance(object):
+    '''The state of a fixture shared by the consumers of one scope.'''
+    def __init__(self, consumers):
+        self.remaining = consumers
+        self.lock = threading.Lock()
+        self.setup_called = False
+        self.exc_info = None
+
 class Fixture(object):
+    '''
+    :attr inputs: Paths of the files the fixture's output depends on. They
+        are part of the key of cached results of the tests using it.
+
+    :attr scope: How widely one setup of the fixture is shared.
+
+        ``'test'``
+            (Default) Set up before and torn down after each test, suite or
+            library which lists the fixture.
+        ``'suite'``
+            Set up once for each suite by its first consumer (the suite or
+            one of its tests) and torn down once the last of them in the
+            schedule finishes.
+        ``'session'``
+            Set up once by its first consumer and torn down once the last
+            consumer in the schedule finishes.
+
+        Consumers are counted by :func:`schedule_finalized`, so subclasses
+        overriding it must call it. A fixture whose consumers were not
+        counted behaves as ``'test'`` scoped.
+
+    :attr outputs: Paths of the files or directories the fixture's setup
+        produces. If :func:`cache_key` returns a key they are stored in the
+        artifact cache, and later setups with the same key restore them
+        instead of calling :func:`setup`.
+
+    :attr background_teardown: If a :data:`teardown_executor` is enabled,
+        whether the fixture may be torn down on it. Fixtures whose teardown
+        must complete before other fixtures are set up should disable it.
+
+    :attr tags: Tags of the suites the fixture serves, or ``None``.
+    :attr tests: Tests (or suites) the fixture serves, or ``None``.
+
+        A global fixture which declares either is not set up when no test
+        left in the filtered schedule is served by it, lists it, or uses a
+        fixture depending on it.
+
+    :attr depends: Fixtures which must be set up before this one. They are
+        set up for every testable using this fixture, even if it doesn't
+        list them itself. Fixtures which don't depend on each other may be
+        set up in parallel.
+    '''
     collector = helper.InstanceCollector()
+    inputs = tuple()
+    outputs = tuple()
+    depends = tuple()
+    background_teardown = True
+    tags = None
+    tests = None
+    scope = 'test'
+    scopes = ('test', 'suite', 'session')
 
     def __new__(klass, *args, **kwargs):
         obj = super(Fixture, klass).__new__(klass, *args, **kwargs)
@@ -18,16 +87,151 @@ class Fixture(object):
 
     def __init__(self, *args, **kwargs):
         self.name = kwargs.pop('name', self.__class__.__name__)
+        # Relative to the directory of the file being loaded.
+        self.inputs = [os.path.abspath(path)
+                       for path in kwargs.pop('inputs', self.inputs)]
+        self.outputs = [os.path.abspath(path)
+                        for path in kwargs.pop('outputs', self.outputs)]
+        self.depends = list(kwargs.pop('depends', self.depends))
+        self.tags = kwargs.pop('tags', self.tags)
+        if self.tags is not None:
+            self.tags = set(self.tags)
+        self.tests = kwargs.pop('tests', self.tests)
+        self.scope = kwargs.pop('scope', self.scope)
+        if self.scope not in self.scopes:
+            raise ValueError('Unknown fixture scope "%s", expected one of %s.'
+                             % (self.scope, ', '.join(self.scopes)))
+        self._scope_instances = None
+        self._scope_lock = threading.Lock()
         self.init(*args, **kwargs)
             
     def skip(self, testitem):
         raise SkipException(self.name, testitem.metadata)
 
     def schedule_finalized(self, schedule):
-        pass
+        '''
+        Called with the schedule of the run before any fixture is set up.
+        Counts the consumers of each scope of the fixture.
+        '''
+        if self.scope == 'test':
+            return
+        consumers = {}
+        testables = [schedule]
+        for suite in schedule:
+            testables.append(suite)
+            testables.extend(suite)
+        for testable in testables:
+            for fixture in with_dependencies(testable.fixtures):
+                if fixture is self:
+                    key = self._scope_key(testable)
+                    consumers[key] = consumers.get(key, 0) + 1
+        self._scope_instances = dict((key, _ScopeInstance(count))
+                                     for key, count in consumers.items())
+
+    def declares_consumers(self):
+        return self.tags is not None or self.tests is not None
+
+    def serves(self, test):
+        '''
+        Return whether the loaded test is one the fixture declares it serves.
+        '''
+        if self.tags and self.tags & set(test.parent_suite.tags):
+            return True
+        if self.tests:
+            return any(obj is test.obj or obj is test.parent_suite.obj
+                       for obj in self.tests)
+        return False
+
+    def _scope_key(self, testitem):
+        if self.scope == 'suite':
+            # The suite of a test, or the suite (or library) itself.
+            return getattr(testitem, 'parent_suite', testitem)
+        return None
+
+    def _scope_instance(self, testitem):
+        '''
+        Return the shared state of the scope of testitem, or ``None`` if the
+        fixture isn't shared with it.
+        '''
+        if self._scope_instances is None:
+            return None
+        return self._scope_instances.get(self._scope_key(testitem))
+
+    def acquire(self, testitem):
+        '''
+        Set the fixture up for testitem, unless it is already set up for the
+        scope of testitem. Consumers sharing a fixture whose setup raised an
+        exception get the same exception.
+        '''
+        instance = self._scope_instance(testitem)
+        if instance is None:
+            self._setup(testitem)
+            return
+        with instance.lock:
+            if not instance.setup_called:
+                instance.setup_called = True
+                try:
+                    self._setup(testitem)
+                except Exception:
+                    instance.exc_info = sys.exc_info()
+                    raise
+            elif instance.exc_info is not None:
+                six.reraise(*instance.exc_info)
+
+    def _setup(self, testitem):
+        if teardown_executor is not None:
+            # Don't set up again while a previous teardown is pending.
+            teardown_executor.wait_for(self)
+        with log.test_log.timed('fixture-setup', self.name):
+            if cache.artifacts is not None and self.outputs:
+                cache.artifacts.setup(self, testitem)
+            else:
+                self.setup(testitem)
+
+    def release(self, testitem):
+        '''
+        Tear the fixture down after testitem, if it was the last consumer of
+        its scope.
+        '''
+        release_all([self], testitem)
+
+    def release_unused(self, testitem):
+        '''
+        Release the fixture for a consumer which didn't acquire it because it
+        was skipped, avoided or replayed from the result cache.
+        '''
+        instance = self._scope_instance(testitem)
+        if instance is not None and self._release_instance(instance):
+            _teardown_all([self], testitem)
+
+    def _last_release(self, testitem):
+        '''
+        Release the fixture for testitem, returning True if it was the last
+        consumer of its scope.
+        '''
+        instance = self._scope_instance(testitem)
+        return instance is None or self._release_instance(instance)
+
+    def _timed_teardown(self, testitem):
+        with log.test_log.timed('fixture-teardown', self.name):
+            self.teardown(testitem)
+
+    def _release_instance(self, instance):
+        '''Return True if the last consumer of the instance released it.'''
+        with self._scope_lock:
+            instance.remaining -= 1
+            return instance.remaining == 0 and instance.setup_called
 
     def init(self, *args, **kwargs):
         pass
+
+    def cache_key(self, testitem):
+        '''
+        Return a string which changes whenever the outputs of setup would,
+        e.g. a hash of its inputs or a revision, to cache the outputs. By
+        default outputs aren't cached.
+        '''
+        return None
     
     def setup(self, testitem):
         pass
@@ -36,6 +240,127 @@ class Fixture(object):
         pass
 
 
+def with_dependencies(fixtures):
+    '''
+    Return the given fixtures and those they (transitively) depend on, each
+    after its dependencies but otherwise in the given order.
+    '''
+    ordered = helper.OrderedSet()
+    visiting = []
+    def visit(fixture):
+        if fixture in ordered:
+            return
+        if fixture in visiting:
+            cycle = visiting[visiting.index(fixture):] + [fixture]
+            raise ValueError('Fixture dependency cycle: %s'
+                             % ' -> '.join(f.name for f in cycle))
+        visiting.append(fixture)
+        for dependency in fixture.depends:
+            visit(dependency)
+        visiting.pop()
+        ordered.add(fixture)
+    for fixture in fixtures:
+        visit(fixture)
+    return list(ordered)
+
+def release_all(fixtures, testitem):
+    '''
+    Release the fixtures after testitem, tearing down those it was the last
+    consumer of in the given order.
+    '''
+    _teardown_all([fixture for fixture in fixtures
+                   if fixture._last_release(testitem)], testitem)
+
+def _teardown_all(fixtures, testitem):
+    '''
+    Tear the fixtures down in order. Those which may be torn down on the
+    :data:`teardown_executor` are submitted to it together, and are torn
+    down before any later fixture which may not.
+    '''
+    background = []
+    for fixture in fixtures:
+        if teardown_executor is not None and fixture.background_teardown:
+            background.append(fixture)
+            continue
+        if background:
+            teardown_executor.submit(background, testitem)
+            for earlier in background:
+                teardown_executor.wait_for(earlier)
+            background = []
+        _logged_teardown(fixture, testitem)
+    if background:
+        teardown_executor.submit(background, testitem)
+
+def _logged_teardown(fixture, testitem):
+    try:
+        fixture._timed_teardown(testitem)
+    except Exception:
+        # Log exception but keep cleaning up.
+        exc = traceback.format_exc()
+        msg = ('Exception raised while tearing down fixture for %s'
+               % testitem.uid)
+        log.test_log.warn('%s\n%s' % (exc, msg))
+
+class TeardownExecutor(object):
+    '''
+    Tears fixtures down on background threads so the next testable can
+    start without waiting for them.
+
+    The fixtures of a testable are submitted together and torn down one
+    after another on the same thread, so a fixture is never torn down
+    before or alongside those depending on it.
+
+    :param workers: Number of threads tearing fixtures down.
+    :param max_pending: Number of submissions which may be queued before
+        submitting another blocks.
+    '''
+    def __init__(self, workers=1, max_pending=8):
+        self._queue = Queue.Queue(max_pending)
+        self._cond = threading.Condition()
+        self._pending = {}
+        for idx in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='flimsy-teardown-%d' % idx)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, fixtures, testitem):
+        '''Queue the fixtures to be torn down after testitem, in order.'''
+        with self._cond:
+            for fixture in fixtures:
+                self._pending[id(fixture)] = (
+                        self._pending.get(id(fixture), 0) + 1)
+        self._queue.put((fixtures, testitem))
+
+    def wait_for(self, fixture):
+        '''Wait until no teardowns of the fixture are pending.'''
+        with self._cond:
+            while self._pending.get(id(fixture)):
+                self._cond.wait()
+
+    def drain(self):
+        '''Wait until all submitted teardowns have completed.'''
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            fixtures, testitem = self._queue.get()
+            try:
+                for fixture in fixtures:
+                    try:
+                        _logged_teardown(fixture, testitem)
+                    finally:
+                        with self._cond:
+                            self._pending[id(fixture)] -= 1
+                            self._cond.notify_all()
+            finally:
+                self._queue.task_done()
+
+def drain_teardowns():
+    '''Wait for the teardowns pending on the teardown executor, if any.'''
+    if teardown_executor is not None:
+        teardown_executor.drain()
+
 def globalfixture(fixture):
     '''Store the given fixture as a global fixture. Its setup() method 
     will be called before the first test is executed.
@@ -1,17 +1,23 @@
 from __future__ import print_function
 
+import collections
+import json
 import multiprocessing
 import os
 import pickle
 import Queue
+import shutil
 import sys
+import tempfile
 import threading
 import time
 import traceback
 
 from config import config
+import compression
 import helper
 import log
+import pack
 import terminal
 import test
 import result
@@ -42,13 +48,63 @@ class Timer():
 
 
 class _TestStreamManager(object):
-    def __init__(self):
+    '''
+    Writes the output of each test to its own stdout and stderr files,
+    closing them once the test's result is logged.
+
+    :param limit: Function returning the output limit of a test result.
+    :param codec: The :class:`compression.Codec` to compress output with, or
+        None to store it uncompressed.
+    '''
+    def __init__(self, limit=lambda test_result: None, codec=None):
         self._writers = {}
+        # Tests whose files were already written, further output is
+        # appended to them.
+        self._written = set()
+        # The bytes saved of each stream of those tests, and whether output
+        # was dropped from it, so appended output keeps to the same limit.
+        self._saved = {}
+        self.limit = limit
+        self.codec = codec
     
     def open_writer(self, test_result):
         if test_result in self._writers:
             raise ValueError('Cannot have multiple writters on a single test.')
-        self._writers[test_result] = _TestStreams(test_result.stdout, test_result.stderr)
+        paths = [test_result.stdout, test_result.stderr]
+        if test_result in self._written:
+            mode = 'a'
+        else:
+            mode = 'w'
+            # Don't leave output of earlier runs stored with other codecs.
+            for path in paths:
+                compression.remove_output(path)
+        if self.codec is not None:
+            paths = [path + self.codec.suffix for path in paths]
+        for path in paths:
+            helper.mkdir_p(os.path.dirname(path))
+        self._writers[test_result] = self._streams(
+                test_result,
+                compression.open_output(paths[0], mode),
+                compression.open_output(paths[1], mode))
+
+    def _streams(self, test_result, stdout, stderr):
+        return _TestStreams(stdout, stderr, self.limit(test_result),
+                            self._saved.get(test_result, {}))
+
+    def written(self, test_result, path):
+        '''
+        Note the output of the test was written to the file at path directly,
+        so any further output is appended to it.
+        '''
+        self.close_writer(test_result)
+        self._written.add(test_result)
+        # The test wrote the file from the start.
+        dropped = _bound_file(path, self.limit(test_result))
+        test_result.dropped_output += dropped
+        self._saved.setdefault(test_result, {})[os.path.basename(path)] = (
+                os.path.getsize(path), dropped > 0)
+        if self.codec is not None:
+            compression.compress_file(path, self.codec)
     
     def get_writer(self, test_result):
         if test_result not in self._writers:
@@ -58,29 +114,231 @@ class _TestStreamManager(object):
     def close_writer(self, test_result):
         if test_result in self._writers:
             writer = self._writers.pop(test_result)
-            writer.close()
+            test_result.dropped_output += writer.close()
+            self._saved[test_result] = writer.saved()
+            self._written.add(test_result)
 
     def close(self):
-        for writer in self._writers.values():
-            writer.close()
-        self._writers.clear()
+        for test_result in list(self._writers):
+            self.close_writer(test_result)
+
+class _PackedStreamManager(_TestStreamManager):
+    '''
+    Buffers the output of each test until its result is logged, then
+    appends it to a :class:`pack.PackWriter`, so only the tests running hold
+    files open.
+
+    Buffers are kept in memory until they grow past spool_size bytes.
+    '''
+    spool_size = 1 << 20
+
+    def __init__(self, pack_writer, limit=lambda test_result: None):
+        super(_PackedStreamManager, self).__init__(limit)
+        self.pack_writer = pack_writer
+
+    def open_writer(self, test_result):
+        if test_result in self._writers:
+            raise ValueError('Cannot have multiple writters on a single test.')
+        self._writers[test_result] = self._streams(
+                test_result,
+                tempfile.SpooledTemporaryFile(self.spool_size),
+                tempfile.SpooledTemporaryFile(self.spool_size))
+
+    def written(self, test_result, path):
+        '''
+        Pack the output the test wrote to the file at path directly as if it
+        had been logged, removing the file.
+        '''
+        writer = getattr(self.get_writer(test_result),
+                         os.path.basename(path))
+        with open(path, 'rb') as f:
+            for buf in iter(lambda: f.read(1 << 16), ''):
+                writer.write(buf)
+        os.remove(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # The other stream is still there.
+            pass
+
+    def close_writer(self, test_result):
+        if test_result not in self._writers:
+            return
+        writer = self._writers.pop(test_result)
+        test_result.dropped_output += writer.finish()
+        self._saved[test_result] = writer.saved()
+        for stream in pack.STREAMS:
+            buf = getattr(writer, stream).file
+            buf.seek(0)
+            self.pack_writer.add(test_result.suite.uid, test_result.uid,
+                                 stream, buf,
+                                 continued=test_result in self._written)
+        self.pack_writer.flush()
+        writer.close()
+        self._written.add(test_result)
+
+    def close(self):
+        super(_PackedStreamManager, self).close()
+        self.pack_writer.close()
 
 class _TestStreams(object):
-    def __init__(self, stdout, stderr):
-        helper.mkdir_p(os.path.dirname(stdout))
-        helper.mkdir_p(os.path.dirname(stderr))
-        self.stdout = open(stdout, 'w')
-        self.stderr = open(stderr, 'w')
+    '''
+    :param saved: The (bytes saved, whether output was dropped) of each
+        stream by earlier writers, by stream name.
+    '''
+    def __init__(self, stdout, stderr, limit=None, saved=None):
+        saved = saved or {}
+        self.stdout = _BoundedFile(stdout, limit,
+                                   *saved.get('stdout', (0, False)))
+        self.stderr = _BoundedFile(stderr, limit,
+                                   *saved.get('stderr', (0, False)))
+
+    def saved(self):
+        '''Return what each stream has saved, as taken by :meth:`__init__`.'''
+        return {'stdout': (self.stdout.saved, self.stdout.cut),
+                'stderr': (self.stderr.saved, self.stderr.cut)}
+
+    def finish(self):
+        '''
+        Write the kept end of the output, returning the number of bytes
+        dropped.
+        '''
+        return self.stdout.finish() + self.stderr.finish()
+
+    def close(self):
+        '''Close the streams, returning the number of bytes dropped.'''
+        return self.stdout.close() + self.stderr.close()
+
+_dropped_marker = '\n... %d bytes of output dropped ...\n'
+
+class _BoundedFile(object):
+    '''
+    A file which, once more than limit bytes are written to it, keeps only
+    the first and last half of the limit with a marker saying how many bytes
+    were dropped in between.
+
+    :param saved: Bytes of the stream an earlier writer saved to the file,
+        which count against the limit.
+    :param cut: Whether the earlier writer already dropped output, in which
+        case all further output is dropped too.
+    '''
+    def __init__(self, file_, limit=None, saved=0, cut=False):
+        self.file = file_
+        self.limit = limit
+        self.saved = saved
+        self.cut = cut
+        if limit is not None:
+            remaining = 0 if cut else max(0, limit - saved)
+            self.head = remaining // 2
+            self.tail = remaining - self.head
+        self.written = 0
+        self.dropped = 0
+        # Output after the head, of which only the last tail bytes are kept.
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._finished = False
+
+    def write(self, buf):
+        if self.limit is None:
+            self.file.write(buf)
+            self.saved += len(buf)
+            return
+        if self.written < self.head:
+            head = buf[:self.head - self.written]
+            self.file.write(head)
+            self.written += len(head)
+            self.saved += len(head)
+            buf = buf[len(head):]
+        if buf:
+            self._tail.append(buf)
+            self._tail_size += len(buf)
+            while (self._tail
+                   and self._tail_size - len(self._tail[0]) >= self.tail):
+                chunk = self._tail.popleft()
+                self._tail_size -= len(chunk)
+                self.dropped += len(chunk)
+
+    def finish(self):
+        '''
+        Write the kept end of the output, returning the number of bytes
+        dropped.
+        '''
+        if self._finished:
+            return 0
+        self._finished = True
+        tail = ''.join(self._tail)
+        if self.limit is not None and len(tail) > self.tail:
+            self.dropped += len(tail) - self.tail
+            tail = tail[len(tail) - self.tail:]
+        if self.dropped and not self.cut:
+            marker = _dropped_marker % self.dropped
+            self.file.write(marker)
+            self.saved += len(marker)
+            self.cut = True
+        self.file.write(tail)
+        self.saved += len(tail)
+        return self.dropped
 
     def close(self):
-        self.stdout.close()
-        self.stderr.close()
+        '''Close the file, returning the number of bytes dropped.'''
+        dropped = self.finish()
+        self.file.close()
+        return dropped
+
+def _bound_file(path, limit):
+    '''
+    Drop the middle of the file like :class:`_BoundedFile` if it is over the
+    limit, returning the number of bytes dropped.
+    '''
+    size = os.path.getsize(path)
+    if limit is None or size <= limit:
+        return 0
+    head = limit // 2
+    tail = limit - head
+    with open(path, 'r+b') as f:
+        f.seek(size - tail)
+        tail = f.read(tail)
+        f.seek(head)
+        f.write(_dropped_marker % (size - limit))
+        f.write(tail)
+        f.truncate()
+    return size - limit
 
 class ResultHandler(log.Handler):
-    def __init__(self, schedule, directory):
+    '''
+    Saves the results of the schedule and the output of its tests to the
+    directory.
+
+    :param previous: Optional :class:`result.InternalLibraryResults` of an
+        earlier run which the results of this run are merged into when saved.
+    :param output_limit: Bytes of each output stream saved for tests which,
+        along with their suite, do not set an ``output_limit``. Beyond it
+        only the start and end of the output are kept.
+    :param compress: Name of the codec in :data:`compression.codecs` to
+        compress output with, or None to store it uncompressed.
+    :param output_format: 'files' to store the output of each test in its
+        own files, or 'packed' to append it to the :mod:`pack` of the
+        results directory.
+    '''
+    def __init__(self, schedule, directory, previous=None, output_limit=None,
+                 compress=None, output_format='files'):
         self.directory = directory
+        self.previous = previous
         self.internal_results = result.InternalLibraryResults(schedule, directory)
-        self.test_stream_manager = _TestStreamManager()
+        self.output_limits = dict(((suite.uid, test.uid), test.output_limit)
+                                  for suite in schedule for test in suite)
+        self.output_limit = output_limit
+        codec = None
+        if compress is not None:
+            codec = compression.codecs[compress]
+        if output_format == 'packed':
+            self.test_stream_manager = _PackedStreamManager(
+                    pack.PackWriter(directory, append=previous is not None,
+                                    codec=codec),
+                    self._output_limit)
+        else:
+            self.test_stream_manager = _TestStreamManager(self._output_limit,
+                                                          codec)
 
         self.mapping = {
             log.LibraryStatus.type_id: self.handle_library_status,
@@ -90,6 +348,7 @@ class ResultHandler(log.Handler):
 
             log.TestStderr.type_id: self.handle_stderr,
             log.TestStdout.type_id: self.handle_stdout,
+            log.TestOutputFile.type_id: self.handle_output_file,
         }
 
     def handle(self, record):
@@ -107,35 +366,241 @@ class ResultHandler(log.Handler):
     def handle_test_result(self, record):
         test_result = self._get_test_result(record)       
         test_result.result = record['result']
+        self.test_stream_manager.close_writer(test_result)
 
     def handle_stderr(self, record):
+        if record['streamed']:
+            return
         self.test_stream_manager.get_writer(
             self._get_test_result(record)
         ).stderr.write(record['buffer'])
 
     def handle_stdout(self, record):
+        if record['streamed']:
+            return
         self.test_stream_manager.get_writer(
             self._get_test_result(record)
         ).stdout.write(record['buffer'])
 
+    def handle_output_file(self, record):
+        self.test_stream_manager.written(self._get_test_result(record),
+                                         record['path'])
+
+    def _output_limit(self, test_result):
+        limit = self.output_limits.get((test_result.suite.uid,
+                                        test_result.uid))
+        if limit is None:
+            limit = self.output_limit
+        return limit
+
     def _get_test_result(self, test_record):
         return self.internal_results.get_test_result(
                     test_record['metadata'].uid, 
                     test_record['metadata'].suite_uid)
 
     def _save(self):
-        #FIXME Hardcoded path name
+        with log.test_log.timed('save', self.directory):
+            self._save_results()
+
+    def _save_results(self):
+        results = self.internal_results
+        if self.previous is not None:
+            self.previous.merge(results)
+            results = self.previous
+        helper.mkdir_p(self.directory)
         result.InternalSavedResults.save(
-            self.internal_results, 
-            os.path.join(self.directory, 'results.pickle'))
+            results,
+            os.path.join(self.directory, config.constants.pickle_filename))
         result.JUnitSavedResults.save(
-            self.internal_results, 
-            os.path.join(self.directory, 'results.xml'))
+            results,
+            os.path.join(self.directory, config.constants.xml_filename),
+            result.OutputReader(self.directory))
 
     def close(self):
+        self.test_stream_manager.close()
         self._save()
 
 
+class ResultCacheHandler(log.Handler):
+    '''
+    Stores the output of passing tests which have a cache key in the
+    :class:`cache.ResultCache` once the run is complete and their output
+    has been written.
+    '''
+    def __init__(self, result_cache):
+        self.result_cache = result_cache
+        self.passed = []
+
+    def handle(self, record):
+        if record.type_id != log.TestResult.type_id:
+            return
+        metadata = record['metadata']
+        if (record['result'].value == state.Result.Passed
+                and metadata.cache_key is not None):
+            self.passed.append(metadata)
+
+    def close(self):
+        reader = result.OutputReader(config.result_path)
+        # Packed output is unpacked here to be stored.
+        tmp = tempfile.mkdtemp()
+        try:
+            for metadata in self.passed:
+                self.result_cache.save(metadata.cache_key, *[
+                        reader.output_file(metadata.suite_uid, metadata.uid,
+                                           stream, tmp)
+                        for stream in pack.STREAMS])
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.result_cache.store.evict()
+
+
+class TimingHandler(log.Handler):
+    '''
+    Collects the :class:`log.Timing` records of the run, saving them along
+    with the total of each phase to a JSON file in the results directory.
+
+    :param top: Number of the costliest steps of each phase to list once
+        the run is complete.
+    '''
+    def __init__(self, directory, top=0):
+        self.directory = directory
+        self.top = top
+        self.timings = []
+
+    def handle(self, record):
+        if record.type_id == log.Timing.type_id:
+            self.timings.append(record.data)
+
+    def phases(self):
+        '''Return a dict of the number of steps and total time of each phase.'''
+        phases = {}
+        for timing in self.timings:
+            phase = phases.setdefault(timing['phase'],
+                                      {'count': 0, 'total': 0.0})
+            phase['count'] += 1
+            phase['total'] += timing['duration']
+        return phases
+
+    def close(self):
+        helper.mkdir_p(self.directory)
+        path = os.path.join(self.directory, config.constants.phases_filename)
+        with open(path, 'w') as f:
+            json.dump({'phases': self.phases(), 'timings': self.timings},
+                      f, indent=1, sort_keys=True)
+        if self.top and self.timings:
+            print(self._display_top())
+
+    def _display_top(self):
+        lines = ['Costliest steps of each phase:']
+        phases = self.phases()
+        for name in sorted(phases, key=lambda name: -phases[name]['total']):
+            lines.append('  %s: %d steps in %.2fs' % (
+                    name, phases[name]['count'], phases[name]['total']))
+            timings = sorted((timing for timing in self.timings
+                              if timing['phase'] == name),
+                             key=lambda timing: -timing['duration'])
+            for timing in timings[:self.top]:
+                lines.append('    %8.2fs  %s' % (timing['duration'],
+                                                 timing['name']))
+        return '\n'.join(lines)
+
+
+class ChromeTraceHandler(log.Handler):
+    '''
+    Streams a timeline of the run to a file in the Chrome trace event
+    format, which can be opened in ``chrome://tracing`` or Perfetto.
+
+    Each library, suite and test is a span on the thread of the runner
+    which ran it, containing spans for its Building, Running and
+    TearingDown statuses. Timed steps, such as fixture setups and
+    teardowns, are spans nested in those of the runner which did them.
+
+    Events are flushed as each record is handled, so the timeline of a run
+    which hangs or is killed can still be opened. Viewers accept a trace
+    missing its closing bracket.
+    '''
+    status_categories = {
+        log.LibraryStatus.type_id: 'library',
+        log.SuiteStatus.type_id: 'suite',
+        log.TestStatus.type_id: 'test',
+    }
+    # Statuses which are shown as spans, the others end the testable.
+    span_statuses = (state.Status.Building, state.Status.Running,
+                     state.Status.TearingDown)
+
+    def __init__(self, path):
+        helper.mkdir_p(os.path.dirname(os.path.abspath(path)))
+        self.file = open(path, 'w')
+        self.file.write('[')
+        self._separator = '\n'
+        self._tids = {}
+        # The (tid, status) of each testable in progress, by category and uid.
+        self._open = {}
+
+    def _write(self, event):
+        self.file.write(self._separator)
+        self.file.write(json.dumps(event, sort_keys=True))
+        self._separator = ',\n'
+
+    def _tid(self, record):
+        pid = record['pid']
+        ident, name = record['thread']
+        if (pid, ident) not in self._tids:
+            self._tids[(pid, ident)] = len(self._tids) + 1
+            self._write({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                         'tid': self._tids[(pid, ident)],
+                         'args': {'name': name}})
+        return self._tids[(pid, ident)]
+
+    def _event(self, phase, name, category, pid, tid, timestamp, **extra):
+        event = {'ph': phase, 'name': name, 'cat': category, 'pid': pid,
+                 'tid': tid, 'ts': int(timestamp * 1e6)}
+        event.update(extra)
+        self._write(event)
+
+    def handle(self, record):
+        if record.type_id in self.status_categories:
+            self.handle_status(record)
+        elif record.type_id == log.Timing.type_id:
+            self._event('X', record['name'], record['phase'], record['pid'],
+                        self._tid(record), record['start'],
+                        dur=int(record['duration'] * 1e6))
+        else:
+            return
+        self.file.flush()
+
+    def handle_status(self, record):
+        category = self.status_categories[record.type_id]
+        metadata = record['metadata']
+        key = (category, metadata.uid)
+        status = record['status']
+        pid = record['pid']
+        timestamp = record['timestamp']
+
+        if key in self._open:
+            tid, open_status = self._open[key]
+            self._event('E', state.Status.name(open_status), category,
+                        pid, tid, timestamp)
+            if status not in self.span_statuses:
+                del self._open[key]
+                self._event('E', metadata.name, category, pid, tid,
+                            timestamp)
+                return
+        elif status in self.span_statuses:
+            tid = self._tid(record)
+            self._event('B', metadata.name, category, pid, tid, timestamp,
+                        args={'uid': metadata.uid})
+        else:
+            return
+        self._open[key] = (tid, status)
+        self._event('B', state.Status.name(status), category, pid, tid,
+                    timestamp)
+
+    def close(self):
+        self.file.write('\n]\n')
+        self.file.close()
+
+
 #TODO Change from a handler to an internal post processor so it can be used to reprint results
 class SummaryHandler(log.Handler):
     color = terminal.get_termcap()
@@ -149,13 +614,19 @@ class SummaryHandler(log.Handler):
     sep_fmtkey = 'separator'
     sep_fmtstr = '{%s}' % sep_fmtkey
 
-    def __init__(self):
+    def __init__(self, slowest=0):
+        '''
+        :param slowest: Number of the slowest tests to list along with the
+            resources they used.
+        '''
         self.mapping = {
             log.TestResult.type_id: self.handle_testresult,
             log.LibraryStatus.type_id: self.handle_library_status,
         }
         self._timer = Timer()
         self.results = []
+        self.slowest = slowest
+        self.usages = []
     
     def handle_library_status(self, record):
         if record['status'] == state.Status.Building:
@@ -165,13 +636,46 @@ class SummaryHandler(log.Handler):
         result = record['result'].value
         if result in (state.Result.Skipped, state.Result.Failed, state.Result.Passed, state.Result.Errored):
             self.results.append(result)
+        usage = record['metadata'].usage
+        if usage is not None and usage.wall is not None:
+            self.usages.append((usage, record['metadata'].uid))
 
     def handle(self, record):
         self.mapping.get(record.type_id, lambda _:None)(record)
 
     def close(self):
+        if self.slowest and self.usages:
+            print(self._display_slowest())
         print(self._display_summary())
 
+    def _display_slowest(self):
+        def fmt(value, format_):
+            return '-' if value is None else format_ % value
+
+        def fmt_rss(usage):
+            if usage.maxrss is not None:
+                return fmt(usage.maxrss / 1024.0, '%.1fMB')
+            # Only the peak of the worker the test shared was measured.
+            return fmt(usage.worker_maxrss and usage.worker_maxrss / 1024.0,
+                       '*%.1fMB')
+
+        slowest = sorted(self.usages, key=lambda usage: -usage[0].wall)
+        lines = ['Slowest %d tests:' % min(self.slowest, len(slowest)),
+                 '%9s %9s %10s %8s %8s  %s' % ('wall', 'cpu', 'max rss',
+                                               'blk in', 'blk out', 'test')]
+        for usage, uid in slowest[:self.slowest]:
+            lines.append('%9s %9s %10s %8s %8s  %s' % (
+                    fmt(usage.wall, '%.2fs'),
+                    fmt(usage.cpu, '%.2fs'),
+                    fmt_rss(usage),
+                    fmt(usage.inblock, '%d'),
+                    fmt(usage.oublock, '%d'),
+                    uid))
+        if any(usage.maxrss is None and usage.worker_maxrss is not None
+               for usage, _ in slowest[:self.slowest]):
+            lines.append('* Peak of the worker the test ran in.')
+        return '\n'.join(lines)
+
     def _display_summary(self):
         most_severe_outcome = None
         outcome_fmt = ' {count} {outcome}'
@@ -305,6 +809,8 @@ class MultiprocessingHandlerWrapper(log.Handler):
         # subhandlers should be accessed with the _handler_lock
         self._handler_lock = threading.Lock()
         self._subhandlers = subhandlers
+        self._closing = False
+        self._closing_records = []
     
     def add_handler(self, handler):
         self._handler_lock.acquire()
@@ -360,14 +866,28 @@ class MultiprocessingHandlerWrapper(log.Handler):
         self._with_handlers(lambda handler: handler.handle(record))
 
     def handle(self, record):
-        self.queue.put(record)
+        if self._closing:
+            self._closing_records.append(record)
+        else:
+            self.queue.put(record)
     
     def close(self):
         self._shutdown.set()
         if hasattr(self, 'thread'):
             self.thread.join()
         _wrap(self._drain)
-        self._with_handlers(lambda handler: _wrap(handler.close))
+
+        # Records logged by a handler while it closes, e.g. the time taken to
+        # save the results, reach the handlers which are yet to close.
+        self._closing = True
+        with self._handler_lock:
+            subhandlers = self._subhandlers
+        for idx, handler in enumerate(subhandlers):
+            _wrap(handler.close)
+            records, self._closing_records = self._closing_records, []
+            for record in records:
+                for later in subhandlers[idx + 1:]:
+                    _wrap(later.handle, record)
 
         # NOTE Python2 has an known bug which causes IOErrors to be raised
         # if this shutdown doesn't go cleanly on both ends.
@@ -0,0 +1,109 @@
+'''
+Wall clock durations recorded from previous runs.
+
+The durations of suites and tests which completed are saved next to the
+results of each run and merged with those recorded by earlier runs. They are
+used to start the longest work first when running in parallel, so a long
+test started last does not set the length of the whole run.
+'''
+import os
+import pickle
+
+import helper
+import runner
+import state
+import wrappers
+
+
+class DurationHistory(object):
+    '''
+    Recorded durations in seconds keyed by suite uid for suites and by
+    ``(suite uid, test uid)`` for tests, since test uids are only unique
+    within their suite.
+    '''
+    filename = 'durations.pickle'
+
+    def __init__(self, durations=None):
+        self.durations = durations if durations is not None else {}
+
+    @classmethod
+    def path(cls, directory):
+        return os.path.join(directory, cls.filename)
+
+    @classmethod
+    def load(cls, path):
+        '''Load the history at path, or an empty history if there is none.'''
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+    def save(self, path, protocol=pickle.HIGHEST_PROTOCOL):
+        helper.mkdir_p(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            pickle.dump(self.durations, f, protocol)
+
+    def update(self, library):
+        '''
+        Record the runtime of every suite and test of the library which
+        completed.
+        '''
+        for suite in library:
+            if self._completed(suite):
+                self.durations[suite.uid] = suite.runtime
+            for test in suite:
+                if self._completed(test):
+                    self.durations[(suite.uid, test.uid)] = test.runtime
+
+    @staticmethod
+    def _completed(testable):
+        return (testable.status == state.Status.Complete
+                and testable.runtime is not None)
+
+    def get(self, testable):
+        '''
+        Return the recorded duration of the suite or test, or ``None`` if it
+        has not completed in a previous run.
+        '''
+        if isinstance(testable, wrappers.LoadedTest):
+            key = (testable.parent_suite.uid, testable.uid)
+        else:
+            key = testable.uid
+        return self.durations.get(key)
+
+    def estimate(self, testable, default):
+        '''
+        Return the recorded duration of the suite or test. Tests without one
+        are estimated at default seconds, and suites without one at the sum
+        of their tests' estimates.
+        '''
+        duration = self.get(testable)
+        if duration is not None:
+            return duration
+        if isinstance(testable, wrappers.LoadedSuite):
+            return sum(self.estimate(test, default) for test in testable)
+        return default
+
+
+class LongestFirstOrder(runner.ScheduledOrder):
+    '''
+    Visit the suites of a library, and the tests of ``parallel`` suites,
+    longest expected duration first. The tests of other suites may depend on
+    each other and are kept in their scheduled order.
+
+    :param history: The :class:`DurationHistory` to estimate durations with.
+    :param default: Estimate in seconds for tests with no recorded duration.
+    '''
+    def __init__(self, history, default):
+        self.history = history
+        self.default = default
+
+    def order(self, testable):
+        children = list(testable)
+        if isinstance(testable, wrappers.LoadedLibrary) or testable.parallel:
+            # sorted() is stable so ties keep their scheduled order.
+            children = sorted(children, key=self.estimate, reverse=True)
+        return iter(children)
+
+    def estimate(self, testable):
+        return self.history.estimate(testable, self.default)
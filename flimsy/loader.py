@@ -6,6 +6,7 @@ import traceback
 import six
 
 import config
+import dependency
 import log
 import suite as suite_mod
 import test as test_mod
@@ -61,6 +62,8 @@ class Loader(object):
         self.suites = []
         self.suite_uids = set()
         self.filepath_filter = default_filepath_filter
+        # Files imported while loading, see :mod:`dependency`.
+        self.dependencies = dependency.DependencyGraph()
     
     @property
     def schedule(self):
@@ -106,6 +109,10 @@ class Loader(object):
 
     def load_file(self, path):
         path = os.path.abspath(path)
+        with log.test_log.timed('load', path):
+            self._load_file(path)
+
+    def _load_file(self, path):
 
         # Create a custom dictionary for the loaded module.
         newdict = {
@@ -137,7 +144,8 @@ class Loader(object):
             config.reset_for_module()
         
         try:
-            execfile(path, newdict, newdict)
+            with self.dependencies.record():
+                execfile(path, newdict, newdict)
         except Exception as e:
             log.test_log.debug(traceback.format_exc())
             log.test_log.warn(
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import contextlib
 import os 
 import sys
 import time
@@ -82,9 +83,16 @@ class Record(object):
     def __str__(self):
         return str(self.data)
 
+def _origin():
+    '''Return where a record is logged from, so it can be placed in time.'''
+    thread = threading.current_thread()
+    return dict(timestamp=time.time(), pid=os.getpid(),
+                thread=(thread.ident, thread.name))
+
 class StatusRecord(Record):
     def __init__(self, obj, status):
-        Record.__init__(self, metadata=obj.metadata, status=status)
+        Record.__init__(self, metadata=obj.metadata, status=status,
+                        **_origin())
 class ResultRecord(Record):
     def __init__(self, obj, result):
         Record.__init__(self, metadata=obj.metadata, result=result)
@@ -106,11 +114,17 @@ class TestStderr(Record):
     pass
 class TestStdout(Record):
     pass
+# A file the test wrote its output to directly, see sandbox.FileIoManager.
+class TestOutputFile(Record):
+    pass
 # Message (Raw String) Types
 class TestMessage(Record):
     pass
 class LibraryMessage(Record):
     pass
+# Time taken by a step of a phase of the run, e.g. loading a file.
+class Timing(Record):
+    pass
 
 
 class Log(object):
@@ -204,17 +218,42 @@ class LogWrapper(object):
     def result_update(self, obj, result):
         self.log_obj.log(self._result_typemap[obj.__class__.__name__](obj, result))
 
+    def timing(self, phase, name, start, duration):
+        origin = _origin()
+        del origin['timestamp']
+        self.log_obj.log(Timing(phase=phase, name=name, start=start,
+                                duration=duration, **origin))
+
+    @contextlib.contextmanager
+    def timed(self, phase, name):
+        '''Log the time taken by the body of the with statement.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(phase, name, start, time.time() - start)
+
     def test_message(self, test, message, level):
         self.log_obj.log(TestMessage(message=message, level=level, 
                 test_uid=test.uid, suite_uid=test.parent_suite.uid))
 
     # NOTE If performance starts to drag on logging stdout/err 
     # replace metadata with just test and suite uid tags.
-    def test_stdout(self, test, suite, buf):
-        self.log_obj.log(TestStdout(buffer=buf, metadata=test.metadata))
-
-    def test_stderr(self, test, suite, buf):
-        self.log_obj.log(TestStderr(buffer=buf, metadata=test.metadata))
+    #
+    # Output which is streamed has already been saved, it is only logged for
+    # handlers which display it.
+    def test_stdout(self, test, suite, buf, streamed=False):
+        self.log_obj.log(TestStdout(buffer=buf, metadata=test.metadata,
+                                    streamed=streamed))
+
+    def test_stderr(self, test, suite, buf, streamed=False):
+        self.log_obj.log(TestStderr(buffer=buf, metadata=test.metadata,
+                                    streamed=streamed))
+
+    def test_output_file(self, test, stream, path):
+        self.log_obj.log(TestOutputFile(metadata=test.metadata, stream=stream,
+                                        path=path,
+                                        size=os.path.getsize(path)))
 
     def close(self):
         self.log_obj.close()
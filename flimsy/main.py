@@ -1,11 +1,25 @@
+import os
+import sys
+
 import runner
+import cache
+import compression
 import config
+import dependency
 import loader as loader_mod
 import fixture as fixture_mod
 import log
+import pack
+import pool
 import handlers
+import helper
+import history
 import terminal
 import query
+import result
+import sandbox
+import shard
+import state
 
 def filter_with_config_tags(loaded_library):
     tags = getattr(config.config, config.StorePositionalTagsAction.position_kword)
@@ -64,8 +78,86 @@ def filter_with_tags(loaded_library, filters):
 
     loaded_library.suites = list(suites)
 
+def select_changed_with_config(loaded_library, dependencies):
+    '''
+    Keep only the suites affected by the changes selected by
+    ``--changed-since``.
+
+    :param dependencies: The :class:`dependency.DependencyGraph` recorded
+        while loading the library.
+    '''
+    since = config.config.changed_since
+    if since is None:
+        return
+    try:
+        changed = dependency.changed_files(since, config.config.directory,
+                                           dependencies.files())
+    except dependency.ChangedFilesError as e:
+        # Reported like an invalid argument, before any test has run.
+        sys.exit('flimsy: error: %s' % e)
+
+    total = len(loaded_library.suites)
+    loaded_library.suites = [suite for suite in loaded_library.suites
+            if not changed.isdisjoint(dependencies.dependencies(suite.path))]
+    log.test_log.info('Selected %d of %d suites changed since %s'
+            % (len(loaded_library.suites), total, since))
+
+def prune_unused_fixtures(loaded_library):
+    '''
+    Remove the global fixtures which declare the tests they serve but serve
+    none left in the schedule, so they are never set up.
+    '''
+    used = set()
+    for suite in loaded_library:
+        used.update(suite.fixtures)
+        for test in suite:
+            used.update(test.fixtures)
+
+    kept = []
+    for fixture in loaded_library.global_fixtures:
+        if (not fixture.declares_consumers() or fixture in used
+                or any(fixture.serves(test)
+                       for suite in loaded_library for test in suite)):
+            kept.append(fixture)
+    # Those still needed by a kept fixture are set up as its dependencies.
+    kept_or_needed = fixture_mod.with_dependencies(
+            kept + list(used))
+
+    pruned = [fixture for fixture in loaded_library.global_fixtures
+              if fixture not in kept_or_needed]
+    loaded_library.global_fixtures = [
+            fixture for fixture in loaded_library.global_fixtures
+            if fixture not in pruned]
+    for fixture in pruned:
+        log.test_log.info('Pruned fixture %s, no scheduled test uses it.'
+                          % fixture.name)
+
+def durations_path():
+    if config.config.durations is not None:
+        return config.config.durations
+    return history.DurationHistory.path(config.config.result_path)
+
+def shard_with_config(loaded_library):
+    '''
+    Keep only the suites of the shard selected by ``--shard K/N``.
+    '''
+    if config.config.shard is None:
+        return
+    index, count = config.config.shard
+
+    estimate = None
+    if config.config.shard_balance:
+        durations = history.DurationHistory.load(durations_path())
+        default = config.config.default_duration
+        estimate = lambda suite: durations.estimate(suite, default)
+
+    total = len(loaded_library.suites)
+    loaded_library.suites = shard.shard_suites(
+            loaded_library.suites, index, count, estimate)
+    log.test_log.info('Selected %d of %d suites for shard %d/%d'
+            % (len(loaded_library.suites), total, index, count))
+
 # TODO Add results command for listing previous results.
-# TODO Add rerun command to re-run failed tests.
 
 def load_tests():
     '''
@@ -83,8 +175,11 @@ def do_list():
     )
     log.test_log.log_obj.add_handler(term_handler)
 
-    test_schedule = load_tests().schedule
+    testloader = load_tests()
+    test_schedule = testloader.schedule
     filter_with_config_tags(test_schedule)
+    select_changed_with_config(test_schedule, testloader.dependencies)
+    shard_with_config(test_schedule)
 
     qrunner = query.QueryRunner(test_schedule)
 
@@ -116,27 +211,155 @@ def do_run():
        * Suite Fixture Teardown
     * Global Fixture Teardown
     '''
+    mp_handler = init_run_log()
+
+    testloader = load_tests()
+    test_schedule = testloader.schedule
+
+    # Filter tests based on tags
+    filter_with_config_tags(test_schedule)
+    select_changed_with_config(test_schedule, testloader.dependencies)
+    shard_with_config(test_schedule)
+
+    if not config.config.no_cache:
+        init_caches(testloader.dependencies, mp_handler)
+
+    run_schedule(test_schedule, mp_handler)
+
+
+def do_rerun():
+    '''
+    Rerun the tests which failed or errored in the results stored at
+    ``result_path``, loading only the files they came from, and merge their
+    new results into the stored ones.
+    '''
+    mp_handler = init_run_log()
+
+    result_path = config.config.result_path
+    previous = result.InternalSavedResults.load(
+            os.path.join(result_path, config.constants.pickle_filename))
+
+    rerun = set()
+    paths = helper.OrderedSet()
+    for suite in previous:
+        for test in suite:
+            if test.result.value in (state.Result.Failed,
+                                     state.Result.Errored):
+                rerun.add((suite.uid, test.uid))
+                paths.add(test.path)
+
+    log.test_log.message(terminal.separator())
+    log.test_log.message('Loading Tests', bold=True)
+    testloader = loader_mod.Loader()
+    for path in paths:
+        testloader.load_file(path)
+    test_schedule = testloader.schedule
+
+    for suite in test_schedule:
+        suite.tests = [test for test in suite
+                       if (suite.uid, test.uid) in rerun]
+    test_schedule.suites = [suite for suite in test_schedule if suite.tests]
+
+    # Clear the stale output of the tests about to be rerun.
+    packed = pack.exists(result_path)
+    if packed:
+        pack_writer = pack.PackWriter(result_path, append=True)
+    for suite in test_schedule:
+        for test in suite:
+            test_result = previous.get_test_result(test.uid, suite.uid)
+            for path in (test_result.stdout, test_result.stderr):
+                compression.remove_output(path)
+            if packed:
+                for stream in pack.STREAMS:
+                    pack_writer.remove(suite.uid, test.uid, stream)
+    if packed:
+        pack_writer.close()
+
+    log.test_log.message('Rerunning %d failed tests of %s'
+            % (sum(len(suite.tests) for suite in test_schedule), result_path),
+            bold=True)
+    run_schedule(test_schedule, mp_handler, previous)
+
+
+def do_export():
+    '''
+    Unpack the packed output of the run stored at ``result_path`` into the
+    files each test would have had if it were not packed.
+    '''
+    term_handler = handlers.TerminalHandler(
+        verbosity=config.config.verbose+log.LogLevel.Info
+    )
+    log.test_log.log_obj.add_handler(term_handler)
+
+    result_path = config.config.result_path
+    reader = pack.PackReader(result_path)
+    reader.export(result_path)
+    log.test_log.message('Unpacked %d streams of output in %s'
+            % (len(reader.ranges), result_path))
+
+
+def init_run_log():
+    '''
+    Add the handlers used while running tests to the log.
 
+    :returns: The :class:`handlers.MultiprocessingHandlerWrapper` further
+        handlers should be added to.
+    '''
     # Initialize early parts of the log.
     term_handler = handlers.TerminalHandler(
         stream=config.config.stream,
         verbosity=config.config.verbose+log.LogLevel.Info
     )
-    summary_handler = handlers.SummaryHandler()
-    mp_handler = handlers.MultiprocessingHandlerWrapper(summary_handler, term_handler)
+    summary_handler = handlers.SummaryHandler(config.config.slowest)
+    timing_handler = handlers.TimingHandler(config.config.result_path,
+                                            config.config.phase_summary)
+    mp_handler = handlers.MultiprocessingHandlerWrapper(
+            timing_handler, summary_handler, term_handler)
+    if config.config.trace is not None:
+        mp_handler.add_handler(
+                handlers.ChromeTraceHandler(config.config.trace))
     mp_handler.async_process()
     log.test_log.log_obj.add_handler(mp_handler)
+    return mp_handler
 
-    test_schedule = load_tests().schedule
 
-    # Filter tests based on tags
-    filter_with_config_tags(test_schedule)
+def init_caches(dependencies, mp_handler):
+    '''
+    Replay the cached results of tests which set ``cache`` and store those
+    which pass, and restore the cached outputs of fixtures.
+    '''
+    store = cache.CacheStore(os.path.join(config.config.cache_dir, 'results'),
+                             config.config.cache_size * 1024 * 1024)
+    cache.results = cache.ResultCache(store, config.config.cache_env,
+                                      dependencies)
+    mp_handler.add_handler(handlers.ResultCacheHandler(cache.results))
+
+    cache.artifacts = cache.ArtifactCache(cache.CacheStore(
+            os.path.join(config.config.cache_dir, 'fixtures'),
+            config.config.fixture_cache_size * 1024 * 1024))
+
 
+def run_schedule(test_schedule, mp_handler, previous_results=None):
+    '''
+    Run the (filtered) test schedule, saving its results in the results
+    directory.
+
+    :param previous_results: Results of an earlier run to merge the results
+        of this run into.
+    '''
     result_path =config.config.result_path
     # Create the result handler object.
-    result_handler = handlers.ResultHandler(test_schedule, result_path)
+    result_handler = handlers.ResultHandler(test_schedule, result_path,
+                                            previous_results,
+                                            config.config.output_limit,
+                                            config.config.compress,
+                                            config.config.output_format)
     mp_handler.add_handler(result_handler)
 
+    prune_unused_fixtures(test_schedule)
+    if cache.results is not None:
+        cache.results.global_fixtures = test_schedule.global_fixtures
+
     # Iterate through all fixtures notifying them of the test schedule.
     for fixture in test_schedule.all_fixtures():
         fixture.schedule_finalized(test_schedule)
@@ -147,9 +370,43 @@ def do_run():
     log.test_log.message("Results will be stored in {}".format(result_path))
     log.test_log.message(terminal.separator())
 
+    durations = history.DurationHistory.load(durations_path())
+    if config.config.order == 'longest-first':
+        runner.set_order(history.LongestFirstOrder(
+                durations, config.config.default_duration))
+
+    sandbox.default_timeout = config.config.timeout
+    sandbox.isolation = config.config.isolation
+    sandbox.batch_size = config.config.batch_size
+    sandbox.capture = config.config.capture
+    sandbox.output_path = result.InternalSavedResults.output_path
+    sandbox.capture_stream = config.config.stream
+    if config.config.background_teardown:
+        fixture_mod.teardown_executor = fixture_mod.TeardownExecutor(
+                config.config.jobs, config.config.teardown_queue_size)
+    if (config.config.isolation == 'worker'
+            or (config.config.isolation is None
+                and any(test.isolation == 'worker'
+                        for suite in test_schedule for test in suite))):
+        sandbox.enable_workers(config.config.worker_max_tests)
+
     # Build global fixtures and exectute scheduled test suites.
-    library_runner = runner.LibraryRunner(test_schedule)
-    library_runner.run()
+    if config.config.jobs > 1:
+        capacity = pool.machine_resources()
+        capacity.update(config.config.resources or {})
+        library_runner = runner.LibraryParallelRunner(
+                test_schedule, config.config.jobs,
+                pool.ResourceBudget(capacity))
+    else:
+        library_runner = runner.LibraryRunner(test_schedule)
+    try:
+        library_runner.run()
+    finally:
+        if sandbox.workers is not None:
+            sandbox.workers.close()
+
+    durations.update(test_schedule)
+    durations.save(durations_path())
 
 
 def main():
@@ -0,0 +1,197 @@
+'''
+A packed store of test output: a single append-only segment file holding the
+output of every test, and an append-only index of where each stream of each
+test is stored in it.
+
+Each line of the index is a JSON list of the suite uid, test uid and stream
+of a range of the segment, the offset and length of the range, the name of
+the codec it was compressed with or null, and whether it continues the
+earlier ranges of the stream rather than replacing them. A stream is
+normally stored in one range, so reading it takes a single seek. Streams of
+rerun tests are appended and replace those of the earlier run, and a range
+with a null offset removes a stream.
+
+The index is written after the ranges it points to, so a run which is
+interrupted leaves a pack readable up to the last test it indexed.
+'''
+import json
+import os
+import shutil
+
+from config import config
+import compression
+import helper
+
+STREAMS = ('stdout', 'stderr')
+
+def exists(directory):
+    return os.path.exists(
+            os.path.join(directory, config.constants.pack_index_filename))
+
+
+class PackWriter(object):
+    '''
+    :param append: Add to the pack already in directory rather than
+        replacing it.
+    :param codec: The :class:`compression.Codec` to compress each range
+        with, or None.
+    '''
+    def __init__(self, directory, append=False, codec=None):
+        helper.mkdir_p(directory)
+        mode = 'ab' if append else 'wb'
+        self.segment = open(
+                os.path.join(directory, config.constants.pack_filename), mode)
+        self.index = open(
+                os.path.join(directory, config.constants.pack_index_filename),
+                mode)
+        self.codec = codec
+
+    def add(self, suite_uid, test_uid, stream, source, continued=False):
+        '''
+        Append the rest of the file object source as the output of the
+        stream.
+
+        :param continued: Add to the output already stored for the stream
+            rather than replacing it.
+        '''
+        self.segment.seek(0, os.SEEK_END)
+        offset = self.segment.tell()
+        if self.codec is None:
+            shutil.copyfileobj(source, self.segment, 1 << 16)
+        else:
+            destination = self.codec.wrap(self.segment, 'w')
+            try:
+                shutil.copyfileobj(source, destination, 1 << 16)
+            finally:
+                destination.close()
+        self._index(suite_uid, test_uid, stream, offset,
+                    self.segment.tell() - offset,
+                    None if self.codec is None else self.codec.name,
+                    continued)
+
+    def remove(self, suite_uid, test_uid, stream):
+        '''Remove the output stored for the stream.'''
+        self._index(suite_uid, test_uid, stream, None, 0, None, False)
+
+    def _index(self, *entry):
+        self.index.write(json.dumps(entry))
+        self.index.write('\n')
+
+    def flush(self):
+        # The ranges must reach the file before the index pointing at them.
+        self.segment.flush()
+        self.index.flush()
+
+    def close(self):
+        self.segment.close()
+        self.index.close()
+
+
+class PackReader(object):
+    '''
+    The index of the pack in directory, which is empty if there is none.
+    '''
+    def __init__(self, directory):
+        self.path = os.path.join(directory, config.constants.pack_filename)
+        self.ranges = {}
+        try:
+            index = open(os.path.join(directory,
+                                      config.constants.pack_index_filename))
+        except IOError:
+            return
+        with index:
+            for line in index:
+                try:
+                    (suite_uid, test_uid, stream, offset, length, codec,
+                     continued) = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted run.
+                    break
+                key = (suite_uid, test_uid, stream)
+                if not continued:
+                    self.ranges[key] = []
+                if offset is not None:
+                    self.ranges.setdefault(key, []).append(
+                            (offset, length, codec))
+
+    def __contains__(self, key):
+        return key in self.ranges
+
+    def open(self, suite_uid, test_uid, stream):
+        '''Return a file object reading the output stored for the stream.'''
+        return _PackedStream(self.path,
+                             self.ranges[(suite_uid, test_uid, stream)])
+
+    def export(self, directory):
+        '''
+        Write each stream to its own file in the layout used when output is
+        not packed, under directory.
+        '''
+        # Imported here as result imports this module.
+        import result
+        for (suite_uid, test_uid, stream) in self.ranges:
+            path = result.InternalSavedResults.output_path(test_uid,
+                                                           suite_uid,
+                                                           directory)
+            helper.mkdir_p(path)
+            source = self.open(suite_uid, test_uid, stream)
+            try:
+                with open(os.path.join(path, stream), 'wb') as destination:
+                    shutil.copyfileobj(source, destination, 1 << 16)
+            finally:
+                source.close()
+
+
+class _PackedStream(object):
+    '''Reads the ranges of a stream from the segment one after the other.'''
+    def __init__(self, path, ranges):
+        self.file = open(path, 'rb')
+        self._ranges = []
+        for offset, length, codec in ranges:
+            reader = _Range(self.file, offset, length)
+            if codec is not None:
+                reader = compression.codecs[codec].wrap(reader, 'r')
+            self._ranges.append(reader)
+
+    def read(self, size=-1):
+        bufs = []
+        while self._ranges and size != 0:
+            buf = self._ranges[0].read(size)
+            if not buf:
+                self._ranges.pop(0)
+                continue
+            bufs.append(buf)
+            if size > 0:
+                size -= len(buf)
+        return ''.join(bufs)
+
+    def close(self):
+        self.file.close()
+
+
+class _Range(object):
+    '''A file object reading length bytes of a file from offset.'''
+    def __init__(self, file_, offset, length):
+        self.file = file_
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence == os.SEEK_END:
+            position += self.length
+        self.position = max(0, min(position, self.length))
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        self.file.seek(self.offset + self.position)
+        buf = self.file.read(size)
+        self.position += len(buf)
+        return buf
@@ -0,0 +1,287 @@
+'''
+Bounded pools of worker threads used by the parallel runners.
+
+Workers spend nearly all of their time blocked on a sandboxed test running in
+a child process, so threads are sufficient and the number of workers bounds
+the number of tests in flight.
+
+Work is kept on a single shared deque. Whole suites are appended to the back
+of the deque, while suites which allow their tests to run in parallel push
+those tests onto the front so idle workers steal them before starting on
+another suite.
+
+Tasks may also declare the resources they need (e.g. ``{'cpus': 8,
+'memory_mb': 16000}``). A pool given a :class:`ResourceBudget` only starts a
+task while its resources fit in what is left of the budget.
+'''
+import collections
+import multiprocessing
+import os
+import sys
+import threading
+
+import six
+
+import log
+
+# Resources needed by a test which doesn't declare any.
+default_resources = {'cpus': 1}
+
+_local = threading.local()
+
+def current():
+    '''
+    Return the :class:`WorkerPool` the calling thread is a worker of, or
+    ``None`` if the thread does not belong to a pool.
+    '''
+    return getattr(_local, 'pool', None)
+
+def machine_resources():
+    '''Return the cpus and memory (in MB) of this machine.'''
+    resources = {'cpus': multiprocessing.cpu_count()}
+    try:
+        resources['memory_mb'] = (os.sysconf('SC_PAGE_SIZE')
+                                  * os.sysconf('SC_PHYS_PAGES')
+                                  // (1024 * 1024))
+    except (ValueError, OSError):
+        pass
+    return resources
+
+def max_resources(resources_list):
+    '''
+    Return the largest amount of each resource in the given resource dicts.
+    '''
+    maximum = {}
+    for resources in resources_list:
+        for name, amount in resources.items():
+            maximum[name] = max(amount, maximum.get(name, 0))
+    return maximum
+
+
+class ResourceBudget(object):
+    '''
+    Tracks the resources in use against a fixed capacity.
+
+    Resources without a capacity are not limited. A request for more than
+    the whole capacity of a resource is clamped to the capacity so it can
+    still run, alone.
+    '''
+    def __init__(self, capacity):
+        self.capacity = dict(capacity)
+        self.used = dict((name, 0) for name in self.capacity)
+
+    def clamp(self, resources):
+        clamped = {}
+        for name, amount in resources.items():
+            if name in self.capacity and amount > self.capacity[name]:
+                log.test_log.warn('Requested %s %s but only %s are'
+                                  ' available.'
+                                  % (amount, name, self.capacity[name]))
+                amount = self.capacity[name]
+            clamped[name] = amount
+        return clamped
+
+    def fits(self, resources):
+        for name, amount in resources.items():
+            if name in self.capacity:
+                if self.used[name] + amount > self.capacity[name]:
+                    return False
+        return True
+
+    def acquire(self, resources):
+        for name, amount in resources.items():
+            if name in self.capacity:
+                self.used[name] += amount
+
+    def release(self, resources):
+        for name, amount in resources.items():
+            if name in self.capacity:
+                self.used[name] -= amount
+
+
+class Task(object):
+    '''
+    A unit of work queued on a :class:`WorkerPool`.
+
+    :attr resources: Dict of the resources the task holds while it runs.
+    '''
+    def __init__(self, callback, *args, **kwargs):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.resources = {}
+        self.done = False
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.callback(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+
+class WorkerPool(object):
+    '''
+    A fixed size pool of daemon worker threads sharing a deque of
+    :class:`Task` items.
+
+    The first exception raised by a task given to :func:`submit` is re-raised
+    by :func:`join` once all work has finished. Exceptions raised by tasks
+    given to :func:`fork` are re-raised by :func:`wait`.
+
+    :param budget: Optional :class:`ResourceBudget` limiting which tasks may
+        run at once.
+    '''
+    def __init__(self, workers, budget=None):
+        if workers < 1:
+            raise ValueError('A WorkerPool requires at least one worker.')
+        self.workers = workers
+        self.budget = budget
+        self._deque = collections.deque()
+        self._cond = threading.Condition()
+        self._outstanding = 0
+        self._stopping = False
+        self._threads = []
+        self._submitted = []
+        # The task at the head of the deque and how many tasks were started
+        # while it didn't fit.
+        self._head = None
+        self._passed_over = 0
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='flimsy-worker-%d' % idx)
+            # Daemon + Join to not lock up main thread if something breaks
+            # but provide consistent execution if nothing goes wrong.
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, task):
+        '''Queue the task at the back of the deque.'''
+        self._clamp(task)
+        with self._cond:
+            self._submitted.append(task)
+            self._outstanding += 1
+            self._deque.append(task)
+            self._cond.notify_all()
+        return task
+
+    def fork(self, tasks):
+        '''
+        Queue the given tasks at the front of the deque, keeping their
+        relative order, so they are stolen before any whole suites.
+        '''
+        for task in tasks:
+            self._clamp(task)
+        with self._cond:
+            self._outstanding += len(tasks)
+            self._deque.extendleft(reversed(tasks))
+            self._cond.notify_all()
+
+    def wait(self, tasks):
+        '''
+        Wait for the given forked tasks to complete.
+
+        Rather than idling, the calling worker runs any of the tasks which
+        have not yet been stolen by another worker.
+        '''
+        while True:
+            with self._cond:
+                pending = [task for task in tasks if task in self._deque]
+                task = self._take(pending)
+                if task is None:
+                    if all(task.done for task in tasks):
+                        break
+                    self._cond.wait()
+                    continue
+            self._run(task)
+
+        for task in tasks:
+            if task.exc_info is not None:
+                six.reraise(*task.exc_info)
+
+    def join(self):
+        '''
+        Wait for all queued work to complete and stop the workers.
+        '''
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        for task in self._submitted:
+            if task.exc_info is not None:
+                six.reraise(*task.exc_info)
+
+    def _clamp(self, task):
+        if self.budget is not None:
+            task.resources = self.budget.clamp(task.resources)
+
+    def _take(self, candidates):
+        '''
+        Remove and return the first candidate whose resources fit in the
+        budget, or ``None``. Must be called holding the condition.
+
+        Once the task at the head of the deque has been passed over for as
+        many tasks as there are workers because it doesn't fit, nothing else
+        is started until it does so that large tasks are not starved by a
+        stream of small ones. This holds for the subsets of the deque
+        workers take their own forked tasks from as well. Tasks which take
+        nothing from the budget are always started, as they can't hold
+        back the head.
+        '''
+        head = self._deque[0] if self._deque else None
+        if head is not self._head:
+            # Count how often each head is passed over from zero.
+            self._head = head
+            self._passed_over = 0
+        for task in candidates:
+            if self._fits(task):
+                if task is head:
+                    self._passed_over = 0
+                elif not self._budgeted(task):
+                    pass
+                elif head is not None and not self._fits(head):
+                    if self._passed_over >= self.workers:
+                        return None
+                    self._passed_over += 1
+                if self.budget is not None:
+                    self.budget.acquire(task.resources)
+                self._deque.remove(task)
+                return task
+        return None
+
+    def _fits(self, task):
+        return self.budget is None or self.budget.fits(task.resources)
+
+    def _budgeted(self, task):
+        '''Whether the task takes any of the budget while it runs.'''
+        return self.budget is not None and any(
+                amount for name, amount in task.resources.items()
+                if name in self.budget.capacity)
+
+    def _run(self, task):
+        task.run()
+        with self._cond:
+            if self.budget is not None:
+                self.budget.release(task.resources)
+            task.done = True
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def _work(self):
+        _local.pool = self
+        while True:
+            with self._cond:
+                task = self._take(self._deque)
+                while task is None:
+                    if (not self._deque and self._stopping
+                            and not self._outstanding):
+                        return
+                    self._cond.wait()
+                    task = self._take(self._deque)
+            self._run(task)
@@ -1,11 +1,15 @@
 import os
 import pickle
+import tempfile
 import xml.sax.saxutils
 
 from config import config
+import compression
 import helper
 import state
 import log
+import pack
+import runner
 
 def _create_uid_index(iterable):
     index = {}
@@ -23,11 +27,26 @@ class _CommonMetadataMixin:
     def uid(self):
         return self._metadata.uid
     @property
+    def path(self):
+        return self._metadata.path
+    @property
     def result(self):
         return self._metadata.result
     @result.setter
     def result(self, result):
         self._metadata.result = result
+    @property
+    def runtime(self):
+        return self._metadata.runtime
+    @property
+    def usage(self):
+        return getattr(self._metadata, 'usage', None)
+    @property
+    def dropped_output(self):
+        return getattr(self._metadata, 'dropped_output', 0)
+    @dropped_output.setter
+    def dropped_output(self, dropped_output):
+        self._metadata.dropped_output = dropped_output
 
 
 class InternalTestResult(object, _CommonMetadataMixin):
@@ -64,6 +83,16 @@ class InternalSuiteResult(object, _CommonMetadataMixin):
 
     def get_test_result(self, uid):
         return self.get_test(uid)
+
+    def add_test(self, test):
+        '''Add the test result, replacing any with the same uid.'''
+        test.suite = self
+        if test.uid in self._tests_index:
+            old = self._tests_index[test.uid]
+            self._tests[self._tests.index(old)] = test
+        else:
+            self._tests.append(test)
+        self._tests_index[test.uid] = test
     
     def aggregate_test_results(self):
         results = {}
@@ -87,9 +116,27 @@ class InternalLibraryResults(object, _CommonMetadataMixin):
         self._suites_index = _create_uid_index(self._suites)
     
     def add_suite(self, suite):
-        if suite.uid in self._suites:
+        if suite.uid in self._suites_index:
             raise ValueError('Cannot have duplicate suite UIDs.')
-        self._suites[suite.uid] = suite
+        self._suites.append(suite)
+        self._suites_index[suite.uid] = suite
+
+    def merge(self, other):
+        '''
+        Merge the results of another (partial) run into these results.
+
+        Test results in other replace those with the same uid, and suites
+        they are merged into have their result recomputed from their tests.
+        '''
+        for suite in other:
+            if suite.uid not in self._suites_index:
+                self.add_suite(suite)
+                continue
+            merged = self._suites_index[suite.uid]
+            for test in suite:
+                merged.add_test(test)
+            merged.result = runner.compute_aggregate_result(merged)
+        self.result = runner.compute_aggregate_result(self)
     
     def get_suite_result(self, suite_uid):
         return self._suites_index[suite_uid]
@@ -120,15 +167,58 @@ class InternalSavedResults:
 
     @staticmethod
     def save(results, path, protocol=pickle.HIGHEST_PROTOCOL):
-        with open(path, 'w') as f:
+        with open(path, 'wb') as f:
             pickle.dump(results, f, protocol)
 
     @staticmethod
     def load(path):
-        with open(path, 'w') as f:
+        with open(path, 'rb') as f:
             return pickle.load(f)
 
 
+class OutputReader(object):
+    '''
+    Reads the saved output of tests in a results directory, whether it was
+    packed or stored in files of its own.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.pack = pack.PackReader(directory)
+
+    def _path(self, suite_uid, test_uid, stream):
+        return compression.find_output(os.path.join(
+                InternalSavedResults.output_path(test_uid, suite_uid,
+                                                 self.directory),
+                stream))
+
+    def open(self, suite_uid, test_uid, stream):
+        '''
+        Return a file object reading the output saved for the stream of the
+        test, raising IOError if there is none.
+        '''
+        if (suite_uid, test_uid, stream) in self.pack:
+            return self.pack.open(suite_uid, test_uid, stream)
+        return compression.open_output(self._path(suite_uid, test_uid,
+                                                  stream))
+
+    def output_file(self, suite_uid, test_uid, stream, directory):
+        '''
+        Return the path of a file holding the output saved for the stream of
+        the test, unpacking it into directory if it was packed.
+        '''
+        if (suite_uid, test_uid, stream) not in self.pack:
+            return self._path(suite_uid, test_uid, stream)
+        fd, path = tempfile.mkstemp(dir=directory)
+        source = self.pack.open(suite_uid, test_uid, stream)
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                for buf in iter(lambda: source.read(1 << 16), ''):
+                    destination.write(buf)
+        finally:
+            source.close()
+        return path
+
+
 class XMLElement(object):
     def write(self, file_):
         self.begin(file_)
@@ -153,6 +243,12 @@ class XMLElement(object):
     def end(self, file_):
         file_.write('</%s>' % self.name)
 
+def time_attribute(testable_result):
+    '''The JUnit ``time`` attribute of the result, or None if not timed.'''
+    if testable_result.runtime is None:
+        return None
+    return XMLAttribute('time', '%.3f' % testable_result.runtime)
+
 class XMLAttribute(object):
     def __init__(self, name, value):
         self.name = name
@@ -171,16 +267,18 @@ class JUnitTestSuites(XMLElement):
         state.Result.Passed: 'tests'
     }
 
-    def __init__(self, internal_results):
+    def __init__(self, internal_results, reader):
         results = internal_results.aggregate_test_results()
         
         self.attributes = []
         for result, tests in results.items():
             self.attributes.append(self.result_attribute(result, str(len(tests))))
+        self.attributes.append(time_attribute(internal_results))
+        self.attributes = filter(None, self.attributes)
 
         self.elements = []
         for suite in internal_results:
-            self.elements.append(JUnitTestSuite(suite))
+            self.elements.append(JUnitTestSuite(suite, reader))
 
     def result_attribute(self, result, count):
         return XMLAttribute(self.result_map[result], count)
@@ -194,7 +292,7 @@ class JUnitTestSuite(JUnitTestSuites):
         state.Result.Skipped: 'skipped'
     }
 
-    def __init__(self, suite_result):
+    def __init__(self, suite_result, reader):
         results = suite_result.aggregate_test_results()
         
         self.attributes = [
@@ -202,58 +300,78 @@ class JUnitTestSuite(JUnitTestSuites):
         ]
         for result, tests in results.items():
             self.attributes.append(self.result_attribute(result, str(len(tests))))
+        self.attributes.append(time_attribute(suite_result))
+        self.attributes = filter(None, self.attributes)
 
         self.elements = []
         for test in suite_result:
-            self.elements.append(JUnitTestCase(test))
+            self.elements.append(JUnitTestCase(test, reader))
 
     def result_attribute(self, result, count):
         return XMLAttribute(self.result_map[result], count)
 
 class JUnitTestCase(XMLElement):
     name = 'testcase'
-    def __init__(self, test_result):
+    def __init__(self, test_result, reader):
         self.attributes = [
             XMLAttribute('name', test_result.name),
             XMLAttribute('classname', test_result.uid), # TODO JUnit expects class of test.. add as test metadata.
             XMLAttribute('status', str(test_result.result)),
         ]
+        self.attributes.append(time_attribute(test_result))
+        self.attributes = filter(None, self.attributes)
 
         # TODO JUnit expects a message for the reason a test was 
         # skipped or errored, save this with the test metadata.
         # http://llg.cubic.org/docs/junit/
         self.elements = [
-            LargeFileElement('system-err', test_result.stderr),
-            LargeFileElement('system-out', test_result.stdout),
+            LargeFileElement('system-err', test_result, 'stderr', reader),
+            LargeFileElement('system-out', test_result, 'stdout', reader),
         ]
 
 class LargeFileElement(XMLElement):
-    def __init__(self, name, filename):
+    '''
+    Element holding the saved output of a stream of a test, read through an
+    :class:`OutputReader` a chunk at a time.
+    '''
+    def __init__(self, name, test_result, stream, reader):
         self.name = name
-        self.filename = filename
+        self.test_result = test_result
+        self.stream = stream
+        self.reader = reader
         self.attributes = []
 
     def body(self, file_):
         try:
-            with open(self.filename, 'r') as f:
-                for line in f:
-                    file_.write(xml.sax.saxutils.escape(line))
+            f = self.reader.open(self.test_result.suite.uid,
+                                 self.test_result.uid, self.stream)
+            try:
+                for buf in iter(lambda: f.read(1 << 16), ''):
+                    file_.write(xml.sax.saxutils.escape(buf))
+            finally:
+                f.close()
         except IOError:
             # TODO Better error logic, this is sometimes O.K. 
             # if there was no stdout/stderr captured for the test
             #
             # TODO If that was the case, the file should still be made and it should just be empty instead of not existing.
-            log.test_log.debug('Error reading from %s' % self.filename)
+            log.test_log.debug('Error reading the %s of %s'
+                               % (self.stream, self.test_result.uid))
 
 
 
 class JUnitSavedResults:
     @staticmethod
-    def save(results, path):
+    def save(results, path, reader=None):
         '''
         Compile the internal results into JUnit format writting it to the given file.
+
+        :param reader: The :class:`OutputReader` of the output of the tests,
+            by default that of the directory holding path.
         '''
-        results = JUnitTestSuites(results)
+        if reader is None:
+            reader = OutputReader(os.path.dirname(path))
+        results = JUnitTestSuites(results, reader)
         with open(path, 'w') as f:
             results.write(f)
     
\ No newline at end of file
@@ -1,10 +1,19 @@
+import multiprocessing
+import sys
+import threading
+import time
 import traceback
 
+import six
+
+import cache
 import fixture
 import state
 import test as test_mod
 import log
+import pool
 import sandbox
+import usage
 from state import Status, Result
 
 def compute_aggregate_result(iterable):
@@ -33,11 +42,44 @@ def compute_aggregate_result(iterable):
     else:
         return Result(Result.Passed)
 
+class ScheduledOrder(object):
+    '''
+    The default order in which runners visit their children: the order in
+    which suites and tests were scheduled.
+    '''
+    def order(self, testable):
+        return iter(testable)
+
+order = ScheduledOrder()
+
+def set_order(new_order):
+    '''
+    Change the order in which runners visit the children of a testable.
+
+    :param new_order: An object providing ``order(testable)`` which returns
+        an iterator over the children of the testable.
+    '''
+    global order
+    order = new_order
+
+def isolation_of(test):
+    '''Return how the test is isolated from the runner.'''
+    return sandbox.isolation or test.isolation or 'process'
+
+def batchable(test):
+    '''Return True if the test may run in a :class:`sandbox.TestBatch`.'''
+    # Batches are forked before test fixtures are built, and a test replayed
+    # from the cache must not be run by its batch.
+    return (isolation_of(test) == 'batch' and not test.fixtures
+            and not (cache.results is not None and test.cache))
+
 class TestParameters(object):
     def __init__(self, test, suite):
         self.test = test
         self.suite = suite
         self.log = log.TestLogWrapper(log.test_log, test, suite)
+        # The usage.Usage the sandbox measured running the test, if any.
+        self.usage = None
 
 class RunnerPattern:
     def __init__(self, loaded_testable):
@@ -53,15 +95,24 @@ class RunnerPattern:
         self.avoid_children(trace)
     
     def avoid_children(self, reason):
+        def avoid(parent):
+            for testable in parent:
+                testable.result = Result(self.testable.result.value, reason)
+                testable.status = Status.Avoided
+                avoid(testable)
+        avoid(self.testable)
         for testable in self.testable:
-            testable.result = Result(self.testable.result.value, reason)
-            testable.status = Status.Avoided
+            release_unused_fixtures(testable)
 
     def test(self):
         pass
 
+    def teardown(self):
+        self.builder.teardown(self.testable)
+
     def run(self):
         avoided = False
+        start = time.time()
         try:
             self.testable.status = Status.Building
             self.builder.setup(self.testable)
@@ -76,7 +127,8 @@ class RunnerPattern:
             self.test()
         finally:
             self.testable.status = Status.TearingDown
-            self.builder.teardown(self.testable)
+            self.teardown()
+        self.testable.runtime = time.time() - start
 
         if avoided:
             self.testable.status = Status.Avoided
@@ -84,45 +136,171 @@ class RunnerPattern:
             self.testable.status = Status.Complete
 
 class TestRunner(RunnerPattern):
+    # The sandbox.TestBatch the test is run by, if any.
+    batch = None
+
+    def run(self):
+        if cache.results is not None and self.testable.cache:
+            fixtures = (list(self.testable.parent_suite.fixtures)
+                        + list(self.testable.fixtures))
+            key = cache.results.key(self.testable, fixtures)
+            if cache.results.replay(self.testable, key):
+                release_unused_fixtures(self.testable)
+                return
+            self.testable.metadata.cache_key = key
+        RunnerPattern.run(self)
+
     def test(self):
         self.sandbox_test()
 
     def sandbox_test(self):
+        isolation = isolation_of(self.testable)
+        # Workers are forked before test fixtures are built, so only tests
+        # without their own fixtures may run in them.
+        if self.batch is not None:
+            sandbox_class = self.batch.run
+        elif isolation == 'none':
+            sandbox_class = sandbox.InProcessSandbox
+        elif (isolation == 'worker' and sandbox.workers is not None
+                and not self.testable.fixtures):
+            sandbox_class = sandbox.WorkerSandbox
+        else:
+            sandbox_class = sandbox.Sandbox
+        timeout = self.testable.timeout
+        if timeout is None:
+            timeout = sandbox.default_timeout
+        params = TestParameters(self.testable, self.testable.parent_suite)
+        start = time.time()
         try:
-            sandbox.Sandbox(TestParameters(
-                    self.testable, 
-                    self.testable.parent_suite))
+            sandbox_class(params, timeout=timeout)
+        except sandbox.TimeoutException:
+            result = Result(Result.Errored, traceback.format_exc())
         except sandbox.SubprocessException:
-            self.testable.result = Result(Result.Failed, traceback.format_exc())
+            result = Result(Result.Failed, traceback.format_exc())
         else:
-            self.testable.result = Result(Result.Passed)
+            result = Result(Result.Passed)
+        # Set before the result so it is logged with it.
+        test_usage = params.usage or usage.Usage()
+        test_usage.wall = time.time() - start
+        log.test_log.timing('test', self.testable.uid, start, test_usage.wall)
+        self.testable.usage = test_usage
+        self.testable.result = result
 
-import threading
 class SuiteRunner(RunnerPattern):
+    def _entrypoint(self, test):
+        test.runner(test).run()
+
+    def batchable(self, test):
+        return batchable(test)
+
+    def _run_batch(self, tests):
+        if not self.batchable(tests[0]):
+            self._entrypoint(tests[0])
+            return
+        batch = sandbox.TestBatch(self.testable, tests, TestParameters)
+        try:
+            for test in tests:
+                runner = test.runner(test)
+                runner.batch = batch
+                runner.run()
+        finally:
+            batch.close()
+
+    def batches(self):
+        '''
+        Yield the tests in order, grouping up to ``sandbox.batch_size``
+        consecutive batchable tests into lists run by one process. Other
+        tests are yielded as a list of their own.
+        '''
+        batch = []
+        for test in order.order(self.testable):
+            if not self.batchable(test):
+                if batch:
+                    yield batch
+                    batch = []
+                yield [test]
+                continue
+            batch.append(test)
+            if len(batch) >= sandbox.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def test(self):
-        for test in self.testable:
-            test.runner(test).run()
+        workers = pool.current()
+        if workers is not None and self.testable.parallel:
+            # Let idle workers steal our tests, helping out while we wait.
+            tasks = []
+            for tests in self.batches():
+                task = pool.Task(self._run_batch, tests)
+                task.resources = pool.max_resources(
+                        test.resources for test in tests)
+                tasks.append(task)
+            workers.fork(tasks)
+            workers.wait(tasks)
+        else:
+            for tests in self.batches():
+                self._run_batch(tests)
+        if sandbox.workers is not None:
+            sandbox.workers.retire(self.testable)
+        self.testable.usage = usage.Usage.total(
+                testable.usage for testable in self.testable)
         self.testable.result = compute_aggregate_result(
                 iter(self.testable))
 
 
 class LibraryRunner(SuiteRunner):
-    pass
+    def batchable(self, suite):
+        return False
+
+    def teardown(self):
+        SuiteRunner.teardown(self)
+        # The library isn't complete until its fixtures are torn down.
+        fixture.drain_teardowns()
+
+
+class LibraryParallelRunner(RunnerPattern):
+    '''
+    Run the suites of the library on a fixed pool of ``jobs`` worker threads.
+
+    Idle workers take whole suites off a shared deque. Suites which set
+    ``parallel`` additionally let idle workers steal their individual tests.
 
+    :param budget: Optional :class:`pool.ResourceBudget`. Tests are only
+        started while the resources they declare fit in the budget. A suite
+        whose tests run in order holds the most its tests need for as long
+        as it runs.
+    '''
+    def __init__(self, loaded_testable, jobs=None, budget=None):
+        RunnerPattern.__init__(self, loaded_testable)
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+        # Set up independent global fixtures in parallel.
+        self.builder = FixtureBuilder(self.testable.fixtures, jobs)
+        self.budget = budget
 
-class LibraryParallelRunner(RunnerPattern):   
     def _entrypoint(self, suite):
         suite.runner(suite).run()
 
+    def teardown(self):
+        RunnerPattern.teardown(self)
+        fixture.drain_teardowns()
+
     def test(self):
-        threads = []
-        for suite in self.testable:
-            thread = threading.Thread(target=self._entrypoint, args=(suite,))
-            thread.daemon = True
-            thread.start()
-            threads.append(thread)
-        for thread in threads:
-            thread.join()
+        workers = pool.WorkerPool(self.jobs, self.budget)
+        workers.start()
+        for suite in order.order(self.testable):
+            task = pool.Task(self._entrypoint, suite)
+            if not suite.parallel:
+                # Tests of parallel suites acquire their own resources.
+                task.resources = pool.max_resources(
+                        test.resources for test in suite)
+            workers.submit(task)
+        workers.join()
+        self.testable.usage = usage.Usage.total(
+                suite.usage for suite in self.testable)
         self.testable.result = compute_aggregate_result(
                 iter(self.testable))
 
@@ -150,32 +328,104 @@ class BrokenFixtureException(Exception):
         ) 
         super(BrokenFixtureException, self).__init__(self.msg)
 
+def release_unused_fixtures(testable):
+    '''
+    Release the shared fixtures of a testable, and of its children, which
+    will not be run.
+    '''
+    for fixture_obj in testable.fixtures:
+        fixture_obj.release_unused(testable)
+    for child in testable:
+        release_unused_fixtures(child)
+
 class FixtureBuilder(object):
-    def __init__(self, fixtures):
-        self.fixtures = fixtures
+    '''
+    Sets up the fixtures of a testable, and those they depend on, after
+    their dependencies, and tears them down in reverse.
+
+    Fixtures which do not depend on each other are set up in parallel on a
+    pool of their own, with as many threads as the worker pool of the
+    calling thread or ``jobs`` threads if it has none. It has no resource
+    budget, as the testable they are set up for already holds its
+    resources. When a fixture fails to set up, the fixtures depending on it
+    are not set up but independent ones still are.
+    '''
+    def __init__(self, fixtures, jobs=1):
+        self.fixtures = fixture.with_dependencies(fixtures)
+        self.jobs = jobs
         self.built_fixtures = []
+        self._lock = threading.Lock()
 
     def setup(self, testitem):
-        for fixture in self.fixtures:
+        # The exc_info of the fixtures which failed, or the fixture whose
+        # failure prevented setting them up.
+        self._failures = {}
+        self._done = dict((id(f), threading.Event()) for f in self.fixtures)
+        tasks = [pool.Task(self._setup_fixture, f, testitem)
+                 for f in self.fixtures]
+
+        workers = pool.current()
+        jobs = self.jobs if workers is None else workers.workers
+        if len(tasks) <= 1 or jobs <= 1:
+            # Dependencies come first, so they are already complete.
+            for task in tasks:
+                task.run()
+                if task.exc_info is not None:
+                    six.reraise(*task.exc_info)
+        else:
+            # Not forked on the calling pool, where they could wait behind a
+            # task needing the resources the calling task holds.
+            workers = pool.WorkerPool(min(jobs, len(tasks)))
+            workers.start()
+            for task in tasks:
+                workers.submit(task)
+            workers.join()
+
+        for fixture_obj in self.fixtures:
+            failure = self._failures.get(id(fixture_obj))
+            if isinstance(failure, tuple):
+                if isinstance(failure[1], SkipException):
+                    six.reraise(*failure)
+                raise BrokenFixtureException(
+                        fixture_obj, testitem,
+                        ''.join(traceback.format_exception(*failure)))
+
+    def _setup_fixture(self, fixture_obj, testitem):
+        try:
+            for dependency in fixture_obj.depends:
+                self._done[id(dependency)].wait()
+                if id(dependency) in self._failures:
+                    log.test_log.warn('Not setting up fixture %s for %s,'
+                            ' it depends on fixture %s which failed.'
+                            % (fixture_obj.name, testitem.uid,
+                               dependency.name))
+                    self._failures[id(fixture_obj)] = dependency
+                    return
+
             # Mark as built before, so if the build fails 
             # we still try to tear it down.
-            self.built_fixtures.append(fixture)
+            with self._lock:
+                self.built_fixtures.append(fixture_obj)
             try:
-                fixture.setup(testitem)
+                fixture_obj.acquire(testitem)
             except SkipException:
-                raise
+                self._failures[id(fixture_obj)] = sys.exc_info()
             except Exception as e:
+                self._failures[id(fixture_obj)] = sys.exc_info()
                 exc = traceback.format_exc()
                 msg = 'Exception raised while setting up fixture for %s' % testitem.uid
                 log.test_log.warn('%s\n%s' % (exc, msg))
-                raise BrokenFixtureException(fixture, testitem, traceback.format_exc())
+        finally:
+            self._done[id(fixture_obj)].set()
         
     def teardown(self, testitem):
-        for fixture in self.built_fixtures:
-            try:
-                fixture.teardown(testitem)
-            except Exception:
-                # Log exception but keep cleaning up.
-                exc = traceback.format_exc()
-                msg = 'Exception raised while tearing down fixture for %s' % testitem.uid
-                log.test_log.warn('%s\n%s' % (exc, msg))
\ No newline at end of file
+        for fixture_obj in self.fixtures:
+            if fixture_obj not in self.built_fixtures:
+                # Not set up since a fixture it depends on failed.
+                fixture_obj.release_unused(testitem)
+        # Dependents first, as a single submission to the teardown executor
+        # so they are still torn down in order in the background.
+        fixture.release_all([fixture_obj
+                             for fixture_obj in reversed(self.fixtures)
+                             if fixture_obj in self.built_fixtures],
+                            testitem)
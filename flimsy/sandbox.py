@@ -1,11 +1,107 @@
+import atexit
+import errno
+import fcntl
 import multiprocessing
+import multiprocessing.util
 import pdb
 import os
+import select
+import signal
 import sys
 import threading
+import time
 import traceback
 
+import helper
 import log
+import usage
+
+# Held while creating a child's pipes, forking it and closing the parent's
+# copies of the child's ends. Otherwise a sibling forked concurrently from
+# another thread inherits those ends and holds the pipes open until it exits.
+_fork_lock = threading.Lock()
+
+# Seconds given to a hung child to dump its stacks before it is killed, and
+# to the logger threads to drain its pipes afterwards.
+STACK_DUMP_WAIT = 1.0
+LOGGER_JOIN_WAIT = 5.0
+
+# Timeout in seconds for tests which, along with their suite, do not set one.
+default_timeout = None
+
+# Isolation used for every test regardless of what it declares, or None.
+isolation = None
+
+# How the output of forked sandboxes is captured: 'pipe' to log it as it is
+# read, or 'file' to have the test write it to its result files directly.
+capture = 'pipe'
+# If True, output captured to files is also logged as it is written, so it
+# can be streamed.
+capture_stream = False
+# Function returning the directory a test's output files are saved in given
+# the uids of the test and its suite, used when capturing to files.
+output_path = None
+
+# Set in a child which was asked to dump its stacks, it is about to be killed.
+_timed_out = False
+
+def _dump_stacks(signum, frame):
+    '''Signal handler which writes the stack of every thread to stderr.'''
+    global _timed_out
+    _timed_out = True
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    dump = []
+    for ident, stack in sys._current_frames().items():
+        # Frames of the parent's threads linger after the fork, skip them.
+        if ident not in names:
+            continue
+        dump.append('\nThread %s (%s), most recent call last:\n'
+                    % (names[ident], ident))
+        dump.extend(traceback.format_stack(stack))
+    sys.stderr.write('Test timed out, dumping stacks:%s' % ''.join(dump))
+    sys.stderr.flush()
+
+def _setup_child():
+    '''
+    Place the child in its own process group, so it and anything it spawns
+    can be killed together, and let it dump its stacks on SIGUSR1.
+    '''
+    try:
+        os.setpgid(0, 0)
+    except OSError:
+        pass
+    signal.signal(signal.SIGUSR1, _dump_stacks)
+
+def _set_process_group(pid):
+    # Also set from the parent so the group exists even if the child has not
+    # run far enough to do it itself.
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+def _kill_hung(process):
+    '''
+    Ask the hung process to dump its stacks, then kill its process group.
+    '''
+    try:
+        os.kill(process.pid, signal.SIGUSR1)
+    except OSError:
+        pass
+    if not process.join(STACK_DUMP_WAIT):
+        _kill(process)
+
+def _kill(process):
+    '''Kill the process group of the process.'''
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    process.join()
 
 pdb._Pdb = pdb.Pdb
 class ForkedPdb(pdb._Pdb):
@@ -69,45 +165,322 @@ class IoManager(object):
         self.log_ouput()
 
     def log_ouput(self):
-        def _log_output(pipe, log_callback):
-            with os.fdopen(pipe, 'r') as pipe:
-                # Read iteractively, don't allow input to fill the pipe.
-                for line in iter(pipe.readline, ''):
-                    log_callback(line)
-
-        # Don't keep a backpointer to self in the thread.            
-        log = self.log
-        test = self.test
-        suite = self.suite
-
-        self.stdout_thread = threading.Thread(
-                target=_log_output,
-                args=(self.stdout_rp, 
-                      lambda buf: log.test_stdout(test, suite, buf))
-        )
-        self.stderr_thread = threading.Thread(
-                target=_log_output,
-                args=(self.stderr_rp, 
-                      lambda buf: log.test_stderr(test, suite, buf))
-        )
-
-        # Daemon + Join to not lock up main thread if something breaks 
-        # but provide consistent execution if nothing goes wrong.
-        self.stdout_thread.daemon = True
-        self.stderr_thread.daemon = True
-        self.stdout_thread.start()
-        self.stderr_thread.start()
-    
-    def join_loggers(self):
-        self.stdout_thread.join()
-        self.stderr_thread.join()
+        self._eof = {'stdout': threading.Event(),
+                     'stderr': threading.Event()}
+        pump = output_pump()
+        for stream, fd in (('stdout', self.stdout_rp),
+                           ('stderr', self.stderr_rp)):
+            pump.add(fd,
+                     lambda buf, stream=stream: self._output(stream, buf),
+                     lambda stream=stream: self._end_of_output(stream))
+
+    def _output(self, stream, buf):
+        if stream == 'stdout':
+            self.log.test_stdout(self.test, self.suite, buf)
+        else:
+            self.log.test_stderr(self.test, self.suite, buf)
+
+    def _end_of_output(self, stream):
+        self._eof[stream].set()
+
+    def join_loggers(self, timeout=None):
+        '''
+        Wait for the output pump to reach the end of the pipes.
+
+        :param timeout: Seconds to wait for each pipe. A process left
+            behind by the test may hold the pipes open, in which case the
+            rest of their output is abandoned with a warning.
+        '''
+        for stream in ('stdout', 'stderr'):
+            if not self._eof[stream].wait(timeout):
+                self.log.warn('Abandoning output of %s, its pipes are still'
+                              ' held open' % (self.test.uid if self.test
+                                              else 'a worker'))
+                return
+
+
+class FileIoManager(IoManager):
+    '''
+    An :class:`IoManager` which has the test write its stdout and stderr
+    straight to its result files rather than to pipes read by the runner.
+
+    The runner only logs a :class:`log.TestOutputFile` record for each file
+    once the test is complete, unless :data:`capture_stream` is set, in
+    which case the files are also tailed and logged as streamed output.
+    '''
+    def __init__(self, test, suite):
+        self.test = test
+        self.suite = suite
+        self.log = log.test_log
+        directory = output_path(test.uid, suite.uid)
+        helper.mkdir_p(directory)
+        self.paths = {'stdout': os.path.join(directory, 'stdout'),
+                      'stderr': os.path.join(directory, 'stderr')}
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.stdout_wp = os.open(self.paths['stdout'], flags, 0666)
+        self.stderr_wp = os.open(self.paths['stderr'], flags, 0666)
+
+    def log_ouput(self):
+        self._tailer = None
+        if capture_stream:
+            self._done = threading.Event()
+            self._tailer = threading.Thread(target=self._tail)
+            self._tailer.daemon = True
+            self._tailer.start()
+
+    def _tail(self):
+        files = [(stream, open(self.paths[stream], 'r'))
+                 for stream in ('stdout', 'stderr')]
+        try:
+            while True:
+                done = self._done.is_set()
+                for stream, f in files:
+                    for buf in iter(lambda: f.read(1 << 16), ''):
+                        if stream == 'stdout':
+                            self.log.test_stdout(self.test, self.suite, buf,
+                                                 streamed=True)
+                        else:
+                            self.log.test_stderr(self.test, self.suite, buf,
+                                                 streamed=True)
+                if done:
+                    return
+                self._done.wait(0.1)
+        finally:
+            for stream, f in files:
+                f.close()
+
+    def join_loggers(self, timeout=None):
+        # Processes left behind by the test may keep writing to the files,
+        # there is no end of output to wait for.
+        if self._tailer is not None:
+            self._done.set()
+            self._tailer.join()
+        for stream in ('stdout', 'stderr'):
+            self.log.test_output_file(self.test, stream, self.paths[stream])
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class OutputPump(object):
+    '''
+    A single thread which reads the output pipes of all running tests.
+
+    Each pipe is read in large non-blocking chunks whenever it is readable,
+    using epoll where available, and the chunks are passed in order to the
+    callback the pipe was added with. Once the pipe reaches EOF it is
+    closed and its EOF callback called.
+    '''
+    chunk_size = 1 << 16
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._mask = select.EPOLLIN
+        else:
+            self._poller = select.poll()
+            self._mask = select.POLLIN
+        self._callbacks = {}
+        # Pipes are registered by the pump thread, woken up to do so.
+        self._added = []
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_nonblocking(self._wakeup_r)
+        self._poller.register(self._wakeup_r, self._mask)
+
+        self.thread = threading.Thread(target=self._pump,
+                                       name='flimsy-output-pump')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, fd, output_callback, eof_callback):
+        '''
+        Read the pipe fd until EOF, taking ownership of it.
+        '''
+        _set_nonblocking(fd)
+        with self._lock:
+            self._added.append((fd, output_callback, eof_callback))
+        os.write(self._wakeup_w, '\0')
+
+    def _register_added(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        with self._lock:
+            added, self._added = self._added, []
+        for fd, output_callback, eof_callback in added:
+            self._callbacks[fd] = (output_callback, eof_callback)
+            self._poller.register(fd, self._mask)
+
+    def _pump(self):
+        while True:
+            try:
+                events = self._poller.poll()
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeup_r:
+                    self._register_added()
+                else:
+                    self._read(fd)
+
+    def _read(self, fd):
+        output_callback, eof_callback = self._callbacks[fd]
+        try:
+            buf = os.read(fd, self.chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            buf = ''
+        try:
+            if buf:
+                output_callback(buf)
+                return
+            self._poller.unregister(fd)
+            del self._callbacks[fd]
+            os.close(fd)
+            eof_callback()
+        except Exception:
+            # Keep pumping the output of other tests.
+            traceback.print_exc()
+
+_output_pump = None
+_output_pump_lock = threading.Lock()
+
+def output_pump():
+    '''Return the :class:`OutputPump`, starting it if needed.'''
+    global _output_pump
+    with _output_pump_lock:
+        if _output_pump is None:
+            _output_pump = OutputPump()
+    return _output_pump
 
 
 class SubprocessException(Exception):
     def __init__(self, exception, trace):
         super(SubprocessException, self).__init__(trace)
 
-class ExceptionProcess(multiprocessing.Process):
+class TimeoutException(SubprocessException):
+    def __init__(self, test, timeout, action='its process group was killed'):
+        self.test = test
+        self.timeout = timeout
+        super(TimeoutException, self).__init__(None,
+                'Test %s timed out after %s seconds, %s.'
+                % (test.uid, timeout, action))
+
+class ForkedProcess(object):
+    '''
+    A forked child process running target, like a
+    :class:`multiprocessing.Process`. It is reaped with ``wait4`` by a
+    thread of its own, rather than by multiprocessing, to get its
+    :class:`usage.Usage` even if it crashed or was killed.
+
+    :ivar exitcode: The exit code of the process, or minus the signal which
+        killed it. None while it is running.
+    :ivar usage: The resources used by the process and the children it
+        waited for, once it has exited.
+    '''
+    def __init__(self, target):
+        self.target = target
+        self.pid = None
+        self.exitcode = None
+        self.usage = None
+        self._exited = threading.Event()
+
+    def start(self):
+        self.pid = os.fork()
+        if self.pid == 0:
+            os._exit(self._bootstrap())
+        _live_processes.add(self)
+        reaper = threading.Thread(target=self._reap,
+                                  name='flimsy-reaper-%d' % self.pid)
+        reaper.daemon = True
+        reaper.start()
+
+    def run(self):
+        self.target()
+
+    def join(self, timeout=None):
+        '''
+        Wait up to timeout seconds for the process to exit, returning
+        whether it has.
+        '''
+        if timeout is None:
+            # In slices, as an untimed wait can't be interrupted.
+            while not self._exited.wait(1.0):
+                pass
+            return True
+        return self._exited.wait(timeout)
+
+    def is_alive(self):
+        return self.pid is not None and not self._exited.is_set()
+
+    def _bootstrap(self):
+        '''Run in the child, returning its exit code.'''
+        # Its siblings aren't its to kill.
+        _live_processes.clear()
+        # As multiprocessing does for its own children.
+        try:
+            sys.stdin.close()
+            sys.stdin = open(os.devnull)
+        except (OSError, ValueError):
+            pass
+        multiprocessing.util._run_after_forkers()
+        try:
+            self.run()
+            exitcode = 0
+        except SystemExit as e:
+            if not e.args:
+                exitcode = 1
+            elif isinstance(e.args[0], int):
+                exitcode = e.args[0]
+            else:
+                sys.stderr.write('%s\n' % e.args[0])
+                exitcode = 1
+        except:
+            exitcode = 1
+            sys.stderr.write('Process %d:\n' % os.getpid())
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        return exitcode
+
+    def _reap(self):
+        while True:
+            try:
+                _, status, rusage = os.wait4(self.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            self.exitcode = -os.WTERMSIG(status)
+        else:
+            self.exitcode = os.WEXITSTATUS(status)
+        self.usage = usage.Usage.from_rusage(rusage)
+        _live_processes.discard(self)
+        self._exited.set()
+
+# ForkedProcesses yet to exit, killed if the runner exits first.
+_live_processes = set()
+
+def _kill_live_processes():
+    for process in list(_live_processes):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+atexit.register(_kill_live_processes)
+
+
+class ExceptionProcess(ForkedProcess):
     class Status():
         def __init__(self, exitcode, exception_tuple):
             self.exitcode = exitcode
@@ -118,8 +491,8 @@ class ExceptionProcess(multiprocessing.Process):
                 self.exception = None
                 self.trace = None
 
-    def __init__(self, *args, **kwargs):
-        multiprocessing.Process.__init__(self, *args, **kwargs)
+    def __init__(self, target):
+        super(ExceptionProcess, self).__init__(target)
         self._pconn, self._cconn = multiprocessing.Pipe()
         self._exception = None
 
@@ -141,23 +514,550 @@ class ExceptionProcess(multiprocessing.Process):
 
 
 class Sandbox(object):
-    def __init__(self, test_parameters):
+    '''
+    Run a test in a freshly forked process.
+
+    :param timeout: Seconds after which the test's stacks are dumped, its
+        process group is killed and :class:`TimeoutException` is raised.
+
+    :raises SubprocessException: If the test failed.
+    '''
+    def __init__(self, test_parameters, timeout=None):
 
         self.params = test_parameters
-        self.io_manager = IoManager(self.params.test, self.params.suite)
+        with _fork_lock:
+            io_manager_class = FileIoManager if capture == 'file' else IoManager
+            self.io_manager = io_manager_class(self.params.test,
+                                               self.params.suite)
 
-        self.p = ExceptionProcess(target=self.entrypoint)
-        self.p.daemon = True # Daemon + Join to not lock up main thread if something breaks
-        self.io_manager.start_loggers()
-        self.p.start()
-        self.io_manager.close_parent_pipes()
-        self.p.join()
-        self.io_manager.join_loggers()
+            self.p = ExceptionProcess(target=self.entrypoint)
+            self.io_manager.start_loggers()
+            self.p.start()
+            _set_process_group(self.p.pid)
+            self.io_manager.close_parent_pipes()
+        if not self.p.join(timeout):
+            _kill_hung(self.p)
+            self.params.usage = self.p.usage
+            self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
+            raise TimeoutException(self.params.test, timeout)
+        self.params.usage = self.p.usage
+        # Processes the test left running may hold its pipes open forever.
+        self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
 
         status = self.p.status
         if status.exitcode:
             raise SubprocessException(status.exception, status.trace)
 
     def entrypoint(self):
+        _setup_child()
+        self.io_manager.setup()
+        self.params.test.test(self.params)
+
+
+class WorkerIoManager(IoManager):
+    '''
+    An :class:`IoManager` whose pipes outlive a single test.
+
+    The worker writes a boundary token to both of its streams after each
+    test. Output read before the token is attributed to the test the worker
+    was running.
+    '''
+    def __init__(self):
+        self.test = None
+        self.suite = None
+        self.log = log.test_log
+        self.boundary = '\0flimsy-boundary-%s\0' % os.urandom(8).encode('hex')
+        self._stdout_done = threading.Event()
+        self._stderr_done = threading.Event()
+        # Output read which might be the start of a boundary.
+        self._pending = {'stdout': '', 'stderr': ''}
+        self._init_pipes()
+
+    def begin_test(self, test, suite):
+        self.test = test
+        self.suite = suite
+        self._stdout_done.clear()
+        self._stderr_done.clear()
+
+    def _log(self, stream, buf):
+        if stream == 'stdout':
+            self.log.test_stdout(self.test, self.suite, buf)
+        else:
+            self.log.test_stderr(self.test, self.suite, buf)
+
+    def _end(self, stream):
+        '''Called when the stream reaches a boundary.'''
+        if stream == 'stdout':
+            self._stdout_done.set()
+        else:
+            self._stderr_done.set()
+
+    def _closed(self, stream):
+        self._end(stream)
+
+    def end_test(self):
+        '''Write the boundary token. Called in the worker.'''
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.write(sys.stdout.fileno(), self.boundary)
+        os.write(sys.stderr.fileno(), self.boundary)
+
+    def wait_for_boundary(self, test, timeout=None):
+        '''
+        Wait for the boundary after the output of the test on both streams,
+        returning False if it did not arrive within timeout seconds.
+        '''
+        return (self._stdout_done.wait(timeout)
+                and self._stderr_done.wait(timeout))
+
+    def _output(self, stream, buf):
+        boundary = self.boundary
+        pending = self._pending[stream] + buf
+        idx = pending.find(boundary)
+        while idx != -1:
+            if idx:
+                self._log(stream, pending[:idx])
+            pending = pending[idx + len(boundary):]
+            self._end(stream)
+            idx = pending.find(boundary)
+        # Hold back anything which might be the start of a boundary.
+        keep = len(boundary) - 1
+        if len(pending) > keep:
+            self._log(stream, pending[:-keep])
+            pending = pending[-keep:]
+        self._pending[stream] = pending
+
+    def _end_of_output(self, stream):
+        if self._pending[stream]:
+            self._log(stream, self._pending[stream])
+            self._pending[stream] = ''
+        self._closed(stream)
+        IoManager._end_of_output(self, stream)
+
+
+class BatchIoManager(WorkerIoManager):
+    '''
+    A :class:`WorkerIoManager` for a worker sent a batch of tests up front.
+    The output of each stream up to its n-th boundary is attributed to the
+    n-th test of the batch.
+    '''
+    def __init__(self, tests, suite):
+        WorkerIoManager.__init__(self)
+        self.tests = list(tests)
+        self.suite = suite
+        self._index = {'stdout': 0, 'stderr': 0}
+        self._done = [{'stdout': threading.Event(),
+                       'stderr': threading.Event()} for test in self.tests]
+
+    def begin_test(self, test, suite):
+        pass
+
+    def _log(self, stream, buf):
+        # Output after the last boundary (e.g. from a crash at exit) is
+        # attributed to the last test.
+        test = self.tests[min(self._index[stream], len(self.tests) - 1)]
+        if stream == 'stdout':
+            self.log.test_stdout(test, self.suite, buf)
+        else:
+            self.log.test_stderr(test, self.suite, buf)
+
+    def _end(self, stream):
+        if self._index[stream] < len(self.tests):
+            self._done[self._index[stream]][stream].set()
+        self._index[stream] += 1
+
+    def _closed(self, stream):
+        for done in self._done[self._index[stream]:]:
+            done[stream].set()
+
+    def wait_for_boundary(self, test, timeout=None):
+        done = self._done[self.tests.index(test)]
+        return done['stdout'].wait(timeout) and done['stderr'].wait(timeout)
+
+
+class TestWorker(object):
+    '''
+    A long lived forked process which runs the tests of a single suite.
+
+    The worker is forked once the suite's fixtures have been built so it
+    shares their state. Test UIDs, or lists of them, are sent to it over a
+    pipe, and it replies to each test with ``None`` if it passed or the
+    formatted traceback if it failed, along with the resources it used.
+
+    :param io_manager: The :class:`WorkerIoManager` attributing the
+        worker's output to its tests.
+    '''
+    # Seconds between checks that the worker is still alive while waiting.
+    poll_interval = 0.1
+
+    def __init__(self, suite, params_class, io_manager=None):
+        self.suite = suite
+        self.tests_run = 0
+        # Set once the worker was killed or exited without replying.
+        self.lost = False
+        # Total of the usage the worker reported for its tests, so a test
+        # it never replied to is given the rest of the worker's usage.
+        self.reported_usage = usage.Usage()
+        self.tests = dict((test.uid, params_class(test, suite))
+                          for test in suite)
+
+        with _fork_lock:
+            if io_manager is None:
+                io_manager = WorkerIoManager()
+            self.io_manager = io_manager
+            # One way pipes, a duplex one may report an error rather than
+            # the results left in it once the worker has exited.
+            self._tests_r, self._tests_w = multiprocessing.Pipe(False)
+            self._results_r, self._results_w = multiprocessing.Pipe(False)
+            self.p = ForkedProcess(self.entrypoint)
+            self.io_manager.start_loggers()
+            self.p.start()
+            _set_process_group(self.p.pid)
+            self.io_manager.close_parent_pipes()
+            self._tests_r.close()
+            self._results_w.close()
+
+    def run(self, test_parameters, timeout=None):
+        '''
+        Run the given test in the worker.
+
+        :raises SubprocessException: If the test failed or the worker died.
+        :raises TimeoutException: If the test took longer than timeout
+            seconds, the worker is killed.
+        '''
+        self.tests_run += 1
+        self.io_manager.begin_test(test_parameters.test, self.suite)
+        try:
+            self._tests_w.send(test_parameters.test.uid)
+        except IOError:
+            pass
+        self.wait(test_parameters, timeout)
+
+    def send(self, tests):
+        '''
+        Queue the tests to be run one after another without waiting for
+        their results, which are collected in order by :meth:`wait`.
+        '''
+        self.tests_run += len(tests)
+        self._tests_w.send([test.uid for test in tests])
+
+    def wait(self, test_parameters, timeout=None):
+        '''
+        Wait for the result of the test the worker was sent.
+
+        :raises SubprocessException: If the test failed or the worker died.
+        :raises TimeoutException: If the test took longer than timeout
+            seconds, the worker is killed.
+        '''
+        try:
+            if not self._poll(timeout):
+                if not self.p.is_alive():
+                    raise EOFError()
+                self.lost = True
+                _kill_hung(self.p)
+                self._unreported_usage(test_parameters)
+                self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
+                raise TimeoutException(test_parameters.test, timeout)
+            trace, test_parameters.usage = self._results_r.recv()
+            self.reported_usage = usage.Usage.total(
+                    (self.reported_usage, test_parameters.usage))
+        except (EOFError, IOError):
+            self.lost = True
+            # Kill anything the worker left running, which may hold its
+            # pipes open.
+            _kill(self.p)
+            self._unreported_usage(test_parameters)
+            self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
+            raise SubprocessException(None,
+                    'Worker process exited with code %s while running %s'
+                    % (self.p.exitcode, test_parameters.test.uid))
+        if not self.io_manager.wait_for_boundary(test_parameters.test,
+                                                 LOGGER_JOIN_WAIT):
+            # The output of its next test couldn't be told apart from this
+            # one's, so the worker is replaced.
+            log.test_log.warn('Lost the end of the output of %s, replacing'
+                              ' its worker' % test_parameters.test.uid)
+            self.lost = True
+            _kill(self.p)
+            self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
+        if trace is not None:
+            raise SubprocessException(None, trace)
+
+    def _unreported_usage(self, test_parameters):
+        '''
+        Give the test the worker died running what the worker used that it
+        didn't report for its earlier tests.
+        '''
+        test_parameters.usage = self.p.usage.since(self.reported_usage)
+
+    def _poll(self, timeout=None):
+        '''
+        Wait for a result from the worker, returning False if none came
+        within timeout seconds or the worker exited without sending one.
+        Processes the worker left running may hold the results pipe open,
+        so its EOF can't be relied on.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - time.time()))
+            if self._results_r.poll(wait):
+                return True
+            if not self.p.is_alive():
+                # It may have sent a result just before exiting.
+                return self._results_r.poll()
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    @property
+    def alive(self):
+        return self.p.is_alive()
+
+    def stop(self):
+        try:
+            self._tests_w.send(None)
+        except IOError:
+            pass
+        self._tests_w.close()
+        self._results_r.close()
+        self.p.join()
+        if not self.lost:
+            # Otherwise already joined when the worker was lost.
+            self.io_manager.join_loggers(LOGGER_JOIN_WAIT)
+
+    def entrypoint(self):
+        self._tests_w.close()
+        self._results_r.close()
+        _setup_child()
         self.io_manager.setup()
-        self.params.test.test(self.params)
\ No newline at end of file
+        while True:
+            try:
+                uids = self._tests_r.recv()
+            except EOFError:
+                return
+            if uids is None:
+                return
+            if not isinstance(uids, list):
+                uids = [uids]
+            for uid in uids:
+                # Don't start another test once the worker is being killed.
+                if _timed_out:
+                    return
+                before = usage.Usage.current()
+                trace = self.run_test(self.tests[uid])
+                self._results_w.send(
+                        (trace, usage.Usage.current().since(before)))
+
+    def run_test(self, params):
+        '''Run the test, returning its traceback if it failed.'''
+        try:
+            params.test.test(params)
+        except Exception:
+            trace = traceback.format_exc()
+        except SystemExit as e:
+            trace = (None if not e.code else
+                     'Test exited with code %s\n%s'
+                     % (e.code, traceback.format_exc()))
+        else:
+            trace = None
+        if trace is not None:
+            # Match the traceback a failed Sandbox leaves in stderr.
+            sys.stderr.write(trace)
+        self.io_manager.end_test()
+        return trace
+
+
+class WorkerSandboxPool(object):
+    '''
+    Keeps idle :class:`TestWorker` processes for each running suite.
+
+    A worker is recycled after running ``max_tests`` tests or if it dies,
+    and all of a suite's workers are stopped by :func:`retire` once the suite
+    has finished so they never outlive its fixtures.
+    '''
+    def __init__(self, max_tests):
+        self.max_tests = max_tests
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, test_parameters):
+        with self._lock:
+            idle = self._idle.get(test_parameters.suite, [])
+            if idle:
+                return idle.pop()
+        return TestWorker(test_parameters.suite, test_parameters.__class__)
+
+    def release(self, worker):
+        if (worker.alive and not worker.lost
+                and worker.tests_run < self.max_tests):
+            with self._lock:
+                helper.append_dictlist(self._idle, worker.suite, worker)
+        else:
+            worker.stop()
+
+    def retire(self, suite):
+        with self._lock:
+            idle = self._idle.pop(suite, [])
+        for worker in idle:
+            worker.stop()
+
+    def close(self):
+        with self._lock:
+            idle = [w for workers in self._idle.values() for w in workers]
+            self._idle.clear()
+        for worker in idle:
+            worker.stop()
+
+workers = None
+
+def enable_workers(max_tests):
+    '''
+    Run tests without their own fixtures in persistent worker processes
+    rather than forking a :class:`Sandbox` for each test.
+    '''
+    global workers
+    workers = WorkerSandboxPool(max_tests)
+    return workers
+
+
+class WorkerSandbox(object):
+    '''
+    Run a test in a persistent :class:`TestWorker` from :data:`workers`.
+    Behaves like :class:`Sandbox`.
+    '''
+    def __init__(self, test_parameters, timeout=None):
+        self.params = test_parameters
+        worker = workers.acquire(test_parameters)
+        try:
+            worker.run(test_parameters, timeout)
+        finally:
+            workers.release(worker)
+
+
+# Number of tests in each TestBatch.
+batch_size = 16
+
+class TestBatch(object):
+    '''
+    Runs a batch of a suite's tests one after another in a single forked
+    process, reporting the result and output of each test separately.
+
+    The tests are all sent to the process when it is forked, so it runs
+    them back to back while the runner reports their results, and
+    :meth:`run` must be called for them in order. If the process dies, the
+    test it was running fails and a new process is forked for the rest of
+    the batch.
+    '''
+    def __init__(self, suite, tests, params_class):
+        self.suite = suite
+        self.params_class = params_class
+        self.remaining = list(tests)
+        self.worker = None
+
+    def run(self, test_parameters, timeout=None):
+        '''
+        Run the next test of the batch. Called like :class:`Sandbox`.
+        '''
+        test = test_parameters.test
+        if not self.remaining or self.remaining[0] is not test:
+            raise ValueError('%s is not the next test of the batch'
+                             % test.uid)
+        if self.worker is None:
+            self.worker = TestWorker(self.suite, self.params_class,
+                    BatchIoManager(self.remaining, self.suite))
+            self.worker.send(self.remaining)
+        self.remaining.pop(0)
+        try:
+            self.worker.wait(test_parameters, timeout)
+        finally:
+            # A worker which died may still have sent the results of the
+            # tests before the one it died in.
+            if self.worker.lost:
+                self.close()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+
+class _CaptureStream(object):
+    '''
+    Replaces sys.stdout or sys.stderr, sending what threads running an
+    in-process test write to that test's output and everything else to the
+    original stream.
+    '''
+    def __init__(self, stream, log_callback):
+        self._stream = stream
+        self._log_callback = log_callback
+
+    def write(self, buf):
+        test = getattr(_capture, 'test', None)
+        if test is None:
+            self._stream.write(buf)
+        else:
+            self._log_callback(test[0], test[1], buf)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if getattr(_capture, 'test', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._stream, attr)
+
+_capture = threading.local()
+_capture_lock = threading.Lock()
+
+def _install_capture():
+    with _capture_lock:
+        if not isinstance(sys.stdout, _CaptureStream):
+            sys.stdout = _CaptureStream(sys.stdout, log.test_log.test_stdout)
+        if not isinstance(sys.stderr, _CaptureStream):
+            sys.stderr = _CaptureStream(sys.stderr, log.test_log.test_stderr)
+
+
+class InProcessSandbox(object):
+    '''
+    Run a test in the runner's own process. Behaves like :class:`Sandbox`,
+    but only what the test writes to ``sys.stdout`` and ``sys.stderr`` from
+    its own thread is captured, and a test which times out can't be killed:
+    it is abandoned and keeps running in the background.
+    '''
+    def __init__(self, test_parameters, timeout=None):
+        self.params = test_parameters
+        self.trace = None
+        _install_capture()
+        if timeout is None:
+            self.entrypoint()
+        else:
+            thread = threading.Thread(target=self.entrypoint,
+                    name='flimsy-inprocess-%s' % test_parameters.test.uid)
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                raise TimeoutException(self.params.test, timeout,
+                        'it was abandoned and is still running')
+        if self.trace is not None:
+            raise SubprocessException(None, self.trace)
+
+    def entrypoint(self):
+        _capture.test = (self.params.test, self.params.suite)
+        try:
+            self.params.test.test(self.params)
+        except Exception:
+            self.trace = traceback.format_exc()
+        except SystemExit as e:
+            if e.code:
+                self.trace = ('Test exited with code %s\n%s'
+                              % (e.code, traceback.format_exc()))
+        finally:
+            if self.trace is not None:
+                # Match the traceback a failed Sandbox leaves in stderr.
+                sys.stderr.write(self.trace)
+            _capture.test = None
@@ -0,0 +1,106 @@
+'''
+Deterministic splitting of a library into disjoint shards so a run can be
+spread across several machines.
+
+Every machine loads and filters the same library and keeps only the suites
+of its own shard. Suites sharing a suite-level fixture instance are always
+placed in the same shard. By default groups of suites are assigned by
+a stable hash of their suite uids. When balancing on recorded durations,
+groups are assigned longest first to the least loaded shard; every machine
+must then use the same duration history to agree on the split.
+'''
+import argparse
+import hashlib
+
+
+def shard_argument(string):
+    '''Argparse type converting ``K/N`` into a ``(K, N)`` tuple.'''
+    try:
+        index, count = (int(part) for part in string.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                'Invalid shard "%s", expected K/N.' % string)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+                'Invalid shard "%s", K must be between 1 and N.' % string)
+    return (index, count)
+
+def stable_hash(string):
+    '''A hash of the string which is the same across processes and hosts.'''
+    return int(hashlib.md5(string).hexdigest(), 16)
+
+def group_suites(suites):
+    '''
+    Group suites which share a suite-level fixture instance.
+
+    :returns: A list of lists of suites. Groups, and the suites within them,
+        keep the order of the given suites.
+    '''
+    # Union-find over suite indices, joined through shared fixtures.
+    parent = list(range(len(suites)))
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    owners = {}
+    for idx, suite in enumerate(suites):
+        for fixture in suite.fixtures:
+            other = owners.setdefault(id(fixture), idx)
+            parent[find(idx)] = find(other)
+
+    groups = {}
+    order = []
+    for idx, suite in enumerate(suites):
+        root = find(idx)
+        if root not in groups:
+            groups[root] = []
+            order.append(root)
+        groups[root].append(suite)
+    return [groups[root] for root in order]
+
+def _group_key(group):
+    return min(suite.uid for suite in group)
+
+def assign_by_hash(groups, count):
+    return [stable_hash(_group_key(group)) % count for group in groups]
+
+def assign_by_duration(groups, count, estimate):
+    '''
+    Assign the longest groups first, each to the least loaded shard.
+
+    :param estimate: Callable returning the expected duration of a suite.
+    '''
+    durations = [sum(estimate(suite) for suite in group) for group in groups]
+    # Break ties by uid rather than load order so every host agrees.
+    by_length = sorted(range(len(groups)),
+                       key=lambda idx: (-durations[idx],
+                                        _group_key(groups[idx])))
+    loads = [0.0] * count
+    assignment = [None] * len(groups)
+    for idx in by_length:
+        shard = loads.index(min(loads))
+        assignment[idx] = shard
+        loads[shard] += durations[idx]
+    return assignment
+
+def shard_suites(suites, index, count, estimate=None):
+    '''
+    Return the suites which belong to shard ``index`` (counting from 1) of
+    ``count``, in their original order.
+
+    :param estimate: If given, balance shards on the expected durations it
+        returns for each suite rather than hashing suite uids.
+    '''
+    groups = group_suites(suites)
+    if estimate is None:
+        assignment = assign_by_hash(groups, count)
+    else:
+        assignment = assign_by_duration(groups, count, estimate)
+
+    selected = set()
+    for group, shard in zip(groups, assignment):
+        if shard == index - 1:
+            selected.update(id(suite) for suite in group)
+    return [suite for suite in suites if id(suite) in selected]
@@ -20,6 +20,18 @@ class TestSuite(object):
         self.fixtures = kwargs.pop('fixtures', getattr(self, 'fixtures', []))
         self.tests = kwargs.pop('tests', getattr(self, 'tests', []))
         self.tags = set(kwargs.pop('tags', []))
+        self.parallel = kwargs.pop('parallel', getattr(self, 'parallel', False))
+        # Default timeout in seconds for the suite's tests.
+        self.timeout = kwargs.pop('timeout', getattr(self, 'timeout', None))
+        # Default resources (e.g. {'cpus': 8}) needed by the suite's tests.
+        self.resources = kwargs.pop('resources', getattr(self, 'resources', None))
+        # Whether the suite's tests may replay cached passing results.
+        self.cache = kwargs.pop('cache', getattr(self, 'cache', False))
+        # How the suite's tests are isolated: 'process', 'worker', 'batch'
+        # or 'none'.
+        self.isolation = kwargs.pop('isolation', getattr(self, 'isolation', None))
+        # Bytes of each output stream saved for each of the suite's tests.
+        self.output_limit = kwargs.pop('output_limit', getattr(self, 'output_limit', None))
         self.init(*args, **kwargs)
 
     def init(self, *args, **kwargs):
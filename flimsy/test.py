@@ -9,6 +9,11 @@ import uid
 class TestCase(object):
     fixtures = tuple()
     runner = runner_mod.TestRunner
+    timeout = None
+    resources = None
+    cache = None
+    isolation = None
+    output_limit = None
     collector = helper.InstanceCollector()
 
     def __new__(klass, *args, **kwargs):
@@ -19,6 +24,11 @@ class TestCase(object):
     def __init__(self, *args, **kwargs):
         self.fixtures = list(self.fixtures)
         self.name = kwargs.pop('name', self.__class__.__name__)
+        self.timeout = kwargs.pop('timeout', self.timeout)
+        self.resources = kwargs.pop('resources', self.resources)
+        self.cache = kwargs.pop('cache', self.cache)
+        self.isolation = kwargs.pop('isolation', self.isolation)
+        self.output_limit = kwargs.pop('output_limit', self.output_limit)
         self.init(*args, **kwargs)
 
     def init(self, *args, **kwargs):
@@ -0,0 +1,109 @@
+'''
+Accounting of the resources used by tests.
+
+Forked sandboxes are reaped with ``wait4``, which gives the resources used
+by the process running the test and the children it waited for, even if it
+crashed or was killed. Workers running many tests measure each with
+``getrusage`` before and after it, which can't split the peak RSS of the
+worker between its tests. The runner measures the wall time. Suites and the
+library are given the totals of their tests.
+'''
+import resource
+
+
+class Usage(object):
+    '''
+    Resources used running a test, or the total used by a suite or library.
+
+    :ivar wall: Seconds the test ran for.
+    :ivar user: Seconds of user CPU time.
+    :ivar sys: Seconds of system CPU time.
+    :ivar maxrss: Peak resident set size in kilobytes of the process the
+        test ran in, which includes what it inherited from the runner.
+    :ivar worker_maxrss: Peak resident set size in kilobytes of the worker
+        the test ran in, which may have run other tests before it, for tests
+        whose own peak couldn't be measured.
+    :ivar inblock: Number of block input operations.
+    :ivar oublock: Number of block output operations.
+
+    Resources which weren't measured are ``None``.
+    '''
+    fields = ('wall', 'user', 'sys', 'maxrss', 'worker_maxrss', 'inblock',
+              'oublock')
+    peaks = ('maxrss', 'worker_maxrss')
+
+    def __init__(self, wall=None, user=None, sys=None, maxrss=None,
+                 inblock=None, oublock=None, worker_maxrss=None):
+        self.wall = wall
+        self.user = user
+        self.sys = sys
+        self.maxrss = maxrss
+        self.worker_maxrss = worker_maxrss
+        self.inblock = inblock
+        self.oublock = oublock
+
+    @classmethod
+    def from_rusage(cls, rusage):
+        '''Return the usage in the result of ``getrusage`` or ``wait4``.'''
+        return cls(user=rusage.ru_utime, sys=rusage.ru_stime,
+                   maxrss=rusage.ru_maxrss, inblock=rusage.ru_inblock,
+                   oublock=rusage.ru_oublock)
+
+    @classmethod
+    def current(cls):
+        '''
+        Return the resources used so far by this process and the children it
+        has waited for.
+        '''
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return cls(user=own.ru_utime + children.ru_utime,
+                   sys=own.ru_stime + children.ru_stime,
+                   maxrss=max(own.ru_maxrss, children.ru_maxrss),
+                   inblock=own.ru_inblock + children.ru_inblock,
+                   oublock=own.ru_oublock + children.ru_oublock)
+
+    def since(self, earlier):
+        '''
+        Return the resources used since the earlier usage, treating those it
+        didn't measure as zero. The peak RSS can't be split, so it is only
+        given as the worker_maxrss.
+        '''
+        def used(field):
+            value = getattr(self, field)
+            if value is None:
+                return None
+            return value - (getattr(earlier, field) or 0)
+        return Usage(user=used('user'), sys=used('sys'),
+                     inblock=used('inblock'), oublock=used('oublock'),
+                     worker_maxrss=self.maxrss)
+
+    @property
+    def cpu(self):
+        '''Seconds of user and system CPU time, or None.'''
+        if self.user is None:
+            return None
+        return self.user + self.sys
+
+    @classmethod
+    def total(cls, usages):
+        '''
+        Return the sum of the usages, skipping any which are ``None``, with
+        the largest peak RSSes among them.
+        '''
+        total = cls()
+        for usage in usages:
+            if usage is None:
+                continue
+            for field in cls.fields:
+                value = getattr(usage, field)
+                if value is None:
+                    continue
+                current = getattr(total, field)
+                if current is None:
+                    setattr(total, field, value)
+                elif field in cls.peaks:
+                    setattr(total, field, max(current, value))
+                else:
+                    setattr(total, field, current + value)
+        return total
@@ -1,6 +1,9 @@
 import itertools
 
+import fixture
+import helper
 import log
+import pool
 import uid
 from state import Status, Result
 
@@ -12,6 +15,12 @@ class TestCaseMetadata():
         self.status = status
         self.result = result
         self.suite_uid = suite_uid
+        self.runtime = None
+        self.usage = None
+        # Key to store the result under if it passes, see cache.ResultCache.
+        self.cache_key = None
+        # Bytes of output dropped for going over the test's output limit.
+        self.dropped_output = 0
 
 
 class TestSuiteMetadata():
@@ -22,13 +31,18 @@ class TestSuiteMetadata():
         self.path = path
         self.status = status
         self.result = result
+        self.runtime = None
+        self.usage = None
 
 
 class LibraryMetadata():
     def __init__(self, name, result, status):
         self.name = name
+        self.uid = name
         self.result = result
         self.status = status
+        self.runtime = None
+        self.usage = None
 
 
 class LoadedTestable(object):
@@ -54,6 +68,22 @@ class LoadedTestable(object):
         self.log_result(result)
         self.metadata.result = result
 
+    @property
+    def runtime(self):
+        return self.metadata.runtime
+
+    @runtime.setter
+    def runtime(self, runtime):
+        self.metadata.runtime = runtime
+
+    @property
+    def usage(self):
+        return self.metadata.usage
+
+    @usage.setter
+    def usage(self, usage):
+        self.metadata.usage = usage
+
     @property
     def uid(self):
         return self.metadata.uid
@@ -61,6 +91,10 @@ class LoadedTestable(object):
     @property
     def name(self):
         return self.metadata.name
+
+    @property
+    def path(self):
+        return self.metadata.path
         
     @property
     def fixtures(self):
@@ -70,6 +104,30 @@ class LoadedTestable(object):
     def runner(self):
         return self.obj.runner
 
+    @property
+    def parallel(self):
+        return getattr(self.obj, 'parallel', False)
+
+    @property
+    def timeout(self):
+        return getattr(self.obj, 'timeout', None)
+
+    @property
+    def resources(self):
+        return getattr(self.obj, 'resources', None)
+
+    @property
+    def cache(self):
+        return getattr(self.obj, 'cache', False)
+
+    @property
+    def isolation(self):
+        return getattr(self.obj, 'isolation', None)
+
+    @property
+    def output_limit(self):
+        return getattr(self.obj, 'output_limit', None)
+
     # TODO Change log to provide status_update, result_update for all types.
     def log_status(self, status):
         log.test_log.status_update(self, status)
@@ -89,6 +147,54 @@ class LoadedTest(LoadedTestable):
 
     def test(self, *args, **kwargs):
         self.obj.test(*args, **kwargs)
+
+    @property
+    def timeout(self):
+        '''The test's timeout, or its suite's if it doesn't set one.'''
+        timeout = getattr(self.obj, 'timeout', None)
+        if timeout is None:
+            timeout = self.parent_suite.timeout
+        return timeout
+
+    @property
+    def resources(self):
+        '''
+        The resources the test declares, or those its suite declares for its
+        tests, or :data:`pool.default_resources`.
+        '''
+        resources = getattr(self.obj, 'resources', None)
+        if resources is None:
+            resources = self.parent_suite.resources
+        if resources is None:
+            resources = pool.default_resources
+        return resources
+
+    @property
+    def cache(self):
+        '''
+        Whether the test allows caching its result, or its suite does if
+        it doesn't set cache.
+        '''
+        cache = getattr(self.obj, 'cache', None)
+        if cache is None:
+            cache = self.parent_suite.cache
+        return cache
+
+    @property
+    def isolation(self):
+        '''The test's isolation, or its suite's if it doesn't set one.'''
+        isolation = getattr(self.obj, 'isolation', None)
+        if isolation is None:
+            isolation = self.parent_suite.isolation
+        return isolation
+
+    @property
+    def output_limit(self):
+        '''The test's output limit, or its suite's if it doesn't set one.'''
+        output_limit = getattr(self.obj, 'output_limit', None)
+        if output_limit is None:
+            output_limit = self.parent_suite.output_limit
+        return output_limit
     
     def _generate_metadata(self):
         return TestCaseMetadata( **{
@@ -145,13 +251,18 @@ class LoadedLibrary(LoadedTestable):
         return iter(self.obj)
 
     def all_fixtures(self):
-        return itertools.chain(
+        '''
+        Return each fixture used by the library, or depended on by those it
+        uses, once.
+        '''
+        return fixture.with_dependencies(helper.OrderedSet(itertools.chain(
             self.global_fixtures,
             *(self.suite_fixtures(suite) for suite in self.obj)
-        )
+        )))
 
     def suite_fixtures(self, suite):
-        return itertools.chain(*(test.fixtures for test in suite))
+        return itertools.chain(suite.fixtures,
+                               *(test.fixtures for test in suite))
     
     @property
     def fixtures(self):
@@ -0,0 +1,28 @@
+import os
+
+import flimsy
+
+# Set by the first test in the memory of the process running the batch.
+batch_pids = []
+
+class BatchedTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        print 'Output of %s' % self.name
+        # --isolation overrides the isolation the suite declares.
+        isolation = flimsy.isolation_of(test_parameters.test)
+        if isolation == 'none':
+            assert os.getpid() == runner_pid
+        else:
+            assert os.getpid() != runner_pid
+        if isolation == 'batch':
+            if not batch_pids:
+                batch_pids.append(os.getpid())
+            assert os.getpid() == batch_pids[0]
+
+runner_pid = os.getpid()
+
+# Tiny tests may share one forked process rather than forking for each.
+flimsy.TestSuite(
+    name='Batched Suite',
+    isolation='batch',
+    tests=[BatchedTestCase(name='Batched %d' % idx) for idx in range(4)])
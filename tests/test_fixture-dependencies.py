@@ -0,0 +1,28 @@
+import time
+
+import flimsy
+
+class BuildFixture(flimsy.Fixture):
+    def init(self, seconds):
+        self.seconds = seconds
+        self.built = False
+
+    def setup(self, testitem):
+        for dependency in self.depends:
+            assert dependency.built
+        time.sleep(self.seconds)
+        self.built = True
+
+# The two libraries don't depend on each other and are built side by side
+# when run with -j, the binary is built once both are.
+libfoo = BuildFixture(0.5, name='libfoo')
+libbar = BuildFixture(0.5, name='libbar')
+binary = BuildFixture(0.1, name='binary', depends=[libfoo, libbar])
+
+class LinkedTestCase(flimsy.TestCase):
+    fixtures = [binary]
+
+    def test(self, test_parameters):
+        assert all(f.built for f in (libfoo, libbar, binary))
+
+LinkedTestCase(name='Linked Test')
@@ -0,0 +1,33 @@
+import time
+
+import flimsy
+
+class SleepFixture(flimsy.Fixture):
+    def init(self, seconds):
+        self.seconds = seconds
+
+    def setup(self, testitem):
+        time.sleep(self.seconds)
+
+class ResourcesTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        pass
+
+class FixturesTestCase(ResourcesTestCase):
+    fixtures = ([SleepFixture(1, name='slow fixture')]
+                + [SleepFixture(0, name='fixture %d' % idx)
+                   for idx in range(3)])
+
+# Run with -j 2 --resources cpus=2, the big test is queued at the head of
+# the deque once the small test holds one of the cpus setting up its
+# fixtures, which must still be set up rather than wait behind it.
+flimsy.TestSuite(
+    name='Fixtures Holding Resources Suite',
+    parallel=False,
+    tests=[FixturesTestCase(name='Small Test', resources={'cpus': 1})])
+
+flimsy.TestSuite(
+    name='Big Resources Suite',
+    parallel=True,
+    fixtures=[SleepFixture(0.5, name='big suite fixture')],
+    tests=[ResourcesTestCase(name='Big Test', resources={'cpus': 2})])
@@ -0,0 +1,19 @@
+import flimsy
+
+class CountingFixture(flimsy.Fixture):
+    def init(self):
+        self.setups = 0
+
+    def setup(self, testitem):
+        self.setups += 1
+
+class SetupOnceTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        # Tests run in a forked process, so this sees the parent's count.
+        assert self.fixtures[0].setups == 1
+
+shared = CountingFixture(name='Shared Fixture', scope='session')
+
+for idx in range(3):
+    test = SetupOnceTestCase(name='Setup Once %d' % idx)
+    test.fixtures = [shared]
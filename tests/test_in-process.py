@@ -0,0 +1,20 @@
+import os
+
+import flimsy
+
+runner_pid = os.getpid()
+
+class InProcessTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        print 'Captured without a sandbox process'
+        # --isolation overrides the isolation the suite declares.
+        if flimsy.isolation_of(test_parameters.test) == 'none':
+            assert os.getpid() == runner_pid
+        else:
+            assert os.getpid() != runner_pid
+
+# Pure python checks may skip the cost of forking a sandbox for each test.
+flimsy.TestSuite(
+    name='In Process Suite',
+    isolation='none',
+    tests=[InProcessTestCase(name='In Process %d' % idx) for idx in range(4)])
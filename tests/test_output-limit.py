@@ -0,0 +1,15 @@
+import flimsy
+
+class ChattyTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        for idx in range(10000):
+            print 'Line %d of output' % idx
+
+# Only the first and last 512 bytes of the output are saved, with a marker
+# of how many bytes were dropped in between.
+ChattyTestCase(name='Chatty Test', output_limit=1024)
+
+flimsy.TestSuite(
+    name='Chatty Suite',
+    output_limit=1024,
+    tests=[ChattyTestCase(name='Chatty Suite Test')])
@@ -0,0 +1,16 @@
+import time
+
+import flimsy
+
+class SleepTestCase(flimsy.TestCase):
+    def init(self, seconds):
+        self.seconds = seconds
+
+    def test(self, test_parameters):
+        time.sleep(self.seconds)
+
+# Tests of a parallel suite may be stolen by idle workers when run with -j.
+flimsy.TestSuite(
+    name='Parallel Sleep Suite',
+    parallel=True,
+    tests=[SleepTestCase(0.1, name='Sleep %d' % idx) for idx in range(8)])
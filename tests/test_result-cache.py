@@ -0,0 +1,28 @@
+import time
+
+import flimsy
+
+class InputFixture(flimsy.Fixture):
+    pass
+
+class SlowDeterministicTestCase(flimsy.TestCase):
+    cache = True
+    fixtures = [InputFixture(inputs=[__file__])]
+
+    def test(self, test_parameters):
+        time.sleep(1)
+        print 'Slow result'
+
+# The second run replays the output of this test unless this file, or the
+# fixture's inputs, changed in between (or --no-cache is given).
+SlowDeterministicTestCase(name='Slow Cached Test')
+
+class UncachedTestCase(SlowDeterministicTestCase):
+    cache = False
+
+# Tests may opt out of caching their suite allows.
+flimsy.TestSuite(
+    name='Cached Suite',
+    cache=True,
+    tests=[SlowDeterministicTestCase(name='Slow Cached Suite Test'),
+           UncachedTestCase(name='Slow Uncached Suite Test')])
@@ -0,0 +1,22 @@
+import subprocess
+import time
+
+import flimsy
+
+class HangingTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        print 'About to hang'
+        time.sleep(3600)
+
+class HangingSubprocessTestCase(flimsy.TestCase):
+    def test(self, test_parameters):
+        # The child holds the test's stdout and stderr open, it should be
+        # killed along with the test.
+        subprocess.call(['sleep', '3600'])
+
+HangingTestCase(name='Hanging Test', timeout=0.5)
+
+flimsy.TestSuite(
+    name='Hanging Suite',
+    timeout=0.5,
+    tests=[HangingSubprocessTestCase(name='Hanging Subprocess Test')])